@@ -0,0 +1,45 @@
+import os
+import time
+from typing import Optional
+
+# whole-turn budget when the request doesn't bring its own
+TURN_DEADLINE_S = float(os.getenv("TURN_DEADLINE_S", "20"))
+# below these remaining budgets the optional stages are skipped
+RECALL_MIN_BUDGET_S = float(os.getenv("RECALL_MIN_BUDGET_S", "3"))
+SEARCH_MIN_BUDGET_S = float(os.getenv("SEARCH_MIN_BUDGET_S", "6"))
+# time kept back for the provider call itself when other stages size their timeouts
+GENERATE_RESERVE_S = float(os.getenv("GENERATE_RESERVE_S", "3"))
+
+
+class DeadlineExceeded(Exception):
+    """Not enough of the turn's time budget left to do this step"""
+    def __init__(self, message: str = "", retry_after: Optional[float] = None):
+        super().__init__(message)
+        # how long until the step could run, when that is known (e.g. a rate-limit wait)
+        self.retry_after = retry_after
+
+
+class Deadline:
+    """Absolute point in (monotonic) time by which the whole turn has to be done"""
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def for_request(cls, deadline_ms: Optional[int] = None) -> "Deadline":
+        if deadline_ms:
+            return cls(min(deadline_ms / 1000, TURN_DEADLINE_S))
+        return cls(TURN_DEADLINE_S)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def allows(self, seconds: float) -> bool:
+        """Is there at least this much time left?"""
+        return self.remaining() >= seconds
+
+    def budget(self, cap: float, keep: float = 0.0) -> float:
+        """Timeout for a stage: its own cap, or whatever is left after keeping `keep` seconds back"""
+        return max(0.0, min(cap, self.remaining() - keep))
@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import time
+import heapq
+import asyncio
+import itertools
+from collections import OrderedDict
+from typing import Optional
+
+# off = plain FIFO in front of the provider limiter; turn on for shared / multi-tenant deployments
+FAIR_SHARE_ENABLED = os.getenv("FAIR_SHARE_ENABLED", "false").lower() == "true"
+# per tier: requests per minute and burst for each client, and its share of the provider budget under contention
+# (the provider's own rpm still applies on top, these only stop one client from taking all of it)
+DEFAULT_TIERS = {
+    "free": {"rpm": 20, "burst": 10, "weight": 1},
+    "pro": {"rpm": 60, "burst": 20, "weight": 4},
+    "service": {"rpm": 120, "burst": 40, "weight": 2},
+    "batch": {"rpm": 600, "burst": 200, "weight": 1},
+}
+RATE_TIERS = {**DEFAULT_TIERS, **json.loads(os.getenv("RATE_TIERS", "{}"))}
+RATE_DEFAULT_TIER = os.getenv("RATE_DEFAULT_TIER", "free")
+# API keys without an entry in RATE_CLIENT_TIERS
+RATE_API_KEY_TIER = os.getenv("RATE_API_KEY_TIER", "service")
+# /messages/batch items, in a bucket of their own so a replay doesn't drain the caller's interactive one
+RATE_BATCH_TIER = os.getenv("RATE_BATCH_TIER", "batch")
+# {"<user id or api key>": "<tier>"}
+RATE_CLIENT_TIERS = json.loads(os.getenv("RATE_CLIENT_TIERS", "{}"))
+
+
+class ClientThrottled(Exception):
+    """A client used up its own bucket and can't wait for a refill within the turn"""
+    def __init__(self, client_id: str, retry_after: float):
+        super().__init__(f"{client_id} over its rate, retry in {retry_after:.1f}s")
+        self.client_id = client_id
+        self.retry_after = retry_after
+
+
+class ClientShare:
+    """One user's (or API key's) token bucket and consumption counters"""
+    def __init__(self, client_id: str, tier: str):
+        limits = RATE_TIERS.get(tier) or RATE_TIERS[RATE_DEFAULT_TIER]
+        self.client_id = client_id
+        self.tier = tier
+        self.rate = limits["rpm"] / 60.0
+        self.burst = float(limits["burst"])
+        self.weight = float(limits.get("weight", 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.tokens_used = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.throttle_wait_s = 0.0
+        self.queue_wait_s = 0.0
+
+    def reserve(self) -> float:
+        """Take one request from the bucket; returns how long to wait before it is really ours"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1.0
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1.0)
+
+    def stats(self) -> dict:
+        return {
+            "tier": self.tier,
+            "requests": self.requests,
+            "tokens": self.tokens_used,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+            "throttle_wait_s": round(self.throttle_wait_s, 2),
+            "queue_wait_s": round(self.queue_wait_s, 2),
+        }
+
+
+class FairQueue:
+    """
+    Weighted fair queuing in front of the shared provider limiter (one slot at a time).
+    Every waiter gets a virtual finish tag = max(virtual clock, client's previous tag) + 1/weight
+    and the free slot always goes to the smallest tag. A client with a long backlog
+    only gets its weighted share, a light user's request goes ahead of it.
+    """
+    def __init__(self):
+        self.virtual = 0.0
+        self.last_tag = {}
+        self.waiters = []
+        self.busy = False
+        self._order = itertools.count()
+
+    async def acquire(self, client_id: str, weight: float):
+        tag = max(self.virtual, self.last_tag.get(client_id, 0.0)) + 1.0 / weight
+        self.last_tag[client_id] = tag
+        if len(self.last_tag) > 10000:
+            # tags behind the virtual clock make no difference any more
+            self.last_tag = {c: t for c, t in self.last_tag.items() if t > self.virtual}
+
+        if not self.busy:
+            self.busy = True
+            self.virtual = tag
+            return
+
+        slot = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (tag, next(self._order), slot))
+        try:
+            await slot
+        except asyncio.CancelledError:
+            # handed the slot just as we were cancelled - pass it on
+            if slot.done() and not slot.cancelled():
+                self.release()
+            raise
+        self.virtual = tag
+
+    def release(self):
+        while self.waiters:
+            _, _, slot = heapq.heappop(self.waiters)
+            if not slot.done():  # cancelled waiters are skipped
+                slot.set_result(None)
+                return
+        self.busy = False
+
+
+class FairShare:
+    """Per-client buckets (bounded LRU) shared by every request in this worker"""
+    def __init__(self, max_clients: int = 10000):
+        self.max_clients = max_clients
+        self.clients = OrderedDict()
+
+    def client(self, user_id: str = "", api_key: Optional[str] = None, batch: bool = False) -> ClientShare:
+        # an API key is the billing identity when there is one, only ever shown hashed
+        client_id = (f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:12]}" if api_key
+                     else f"user:{user_id or 'anonymous'}")
+        if batch:
+            client_id += ":batch"
+        share = self.clients.get(client_id)
+        if share is None:
+            tier = (RATE_CLIENT_TIERS.get(api_key or "") or RATE_CLIENT_TIERS.get(user_id)
+                    or (RATE_BATCH_TIER if batch else RATE_API_KEY_TIER if api_key else RATE_DEFAULT_TIER))
+            share = self.clients[client_id] = ClientShare(client_id, tier)
+            if len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+        else:
+            self.clients.move_to_end(client_id)
+        return share
+
+    async def throttle(self, share: ClientShare, max_wait: Optional[float] = None):
+        """Wait for the client's own bucket; raise ClientThrottled if that takes longer than max_wait"""
+        wait = share.reserve()
+        if wait > 0:
+            if max_wait is not None and wait > max_wait:
+                share.refund()
+                share.rejected += 1
+                raise ClientThrottled(share.client_id, wait)
+            share.throttled += 1
+            share.throttle_wait_s += wait
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                share.refund()  # never got used
+                raise
+        share.requests += 1
+
+    def stats(self, top: int = 20) -> dict:
+        heaviest = sorted(self.clients.values(), key=lambda s: s.tokens_used, reverse=True)[:top]
+        return {
+            "clients": len(self.clients),
+            "throttled": sum(s.throttled for s in self.clients.values()),
+            "rejected": sum(s.rejected for s in self.clients.values()),
+            "top": {s.client_id: s.stats() for s in heaviest},
+        }
+
+
+fair_share = FairShare()
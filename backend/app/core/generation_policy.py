@@ -0,0 +1,72 @@
+import os
+import json
+import threading
+import numpy as np
+from collections import deque
+
+GEN_POLICY_ENABLED = os.getenv("GEN_POLICY_ENABLED", "true").lower() == "true"
+
+# the persona answers in 1-3 sentences most of the time, only explanations run long
+DEFAULT_POLICY = {
+    "casual": {"max_tokens": 120, "temperature": 0.8},
+    "search": {"max_tokens": 200, "temperature": 0.6},
+    "emotional": {"max_tokens": 220, "temperature": 0.7},
+    "explanation": {"max_tokens": 400, "temperature": 0.5},
+}
+# what every turn got before the policy existed
+FALLBACK = {"max_tokens": 256, "temperature": 0.7}
+
+# e.g. GEN_POLICY={"explanation": {"max_tokens": 500, "model": "llama-3.1-8b-instant"}}
+_overrides = json.loads(os.getenv("GEN_POLICY", "{}"))
+GEN_POLICY = {
+    turn_type: {**DEFAULT_POLICY.get(turn_type, FALLBACK), **_overrides.get(turn_type, {})}
+    for turn_type in {*DEFAULT_POLICY, *_overrides}
+}
+
+
+def settings_for(turn_type: str) -> dict:
+    """max_tokens / temperature (and optional model) for a turn of this type"""
+    if not GEN_POLICY_ENABLED:
+        return dict(FALLBACK)
+    return dict(GEN_POLICY.get(turn_type, GEN_POLICY["casual"]))
+
+
+class OutputTokenStats:
+    """Actual vs. allowed reply tokens per turn type, to tune the policy from real traffic"""
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._types = {}
+        self._lock = threading.Lock()
+
+    def record(self, turn_type: str, allowed: int, actual: int):
+        with self._lock:
+            entry = self._types.setdefault(turn_type, {
+                "turns": 0, "allowed": 0, "actual": 0, "at_limit": 0, "recent": deque(maxlen=self.window)
+            })
+            entry["turns"] += 1
+            entry["allowed"] += allowed
+            entry["actual"] += actual
+            # within 10% of the cap is most likely a cut-off reply
+            if actual >= 0.9 * allowed:
+                entry["at_limit"] += 1
+            entry["recent"].append(actual)
+
+    def stats(self) -> dict:
+        with self._lock:
+            report = {}
+            for turn_type, entry in self._types.items():
+                recent = np.asarray(entry["recent"])
+                report[turn_type] = {
+                    "turns": entry["turns"],
+                    "avg_allowed": round(entry["allowed"] / entry["turns"], 1),
+                    "avg_actual": round(entry["actual"] / entry["turns"], 1),
+                    "utilisation": round(entry["actual"] / entry["allowed"], 3) if entry["allowed"] else 0.0,
+                    "at_limit_rate": round(entry["at_limit"] / entry["turns"], 3),
+                    "p50_actual": int(np.percentile(recent, 50)),
+                    "p95_actual": int(np.percentile(recent, 95)),
+                    "policy": settings_for(turn_type),
+                }
+            return report
+
+
+output_token_stats = OutputTokenStats()
@@ -0,0 +1,89 @@
+import os
+import threading
+from collections import deque
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+# where the duplicate goes: another provider (its *_MODEL is used), or the same one with HEDGE_MODEL
+HEDGE_PROVIDER = os.getenv("HEDGE_PROVIDER", "").lower()
+HEDGE_MODEL = os.getenv("HEDGE_MODEL", "")
+# fire the hedge once the primary is slower than this percentile of its recent latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+# used until a provider has HEDGE_MIN_SAMPLES latencies on record
+HEDGE_DEFAULT_DELAY_S = float(os.getenv("HEDGE_DEFAULT_DELAY_S", "3.0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# at most this fraction of requests may be duplicated
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per provider"""
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider: str, p: float, default: float = HEDGE_DEFAULT_DELAY_S,
+                   min_samples: int = HEDGE_MIN_SAMPLES) -> float:
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if len(samples) < min_samples:
+            return default
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def stats(self) -> dict:
+        return {
+            provider: {
+                "samples": len(self._samples.get(provider, ())),
+                "p50_s": round(self.percentile(provider, 0.5, default=0.0, min_samples=1), 3),
+                "p95_s": round(self.percentile(provider, 0.95, default=0.0, min_samples=1), 3),
+            }
+            for provider in list(self._samples)
+        }
+
+
+class HedgeBudget:
+    """
+    Token bucket earning `ratio` of a hedge per primary request, so hedges stay
+    under ratio * traffic (plus a small burst) no matter how slow providers get.
+    """
+    def __init__(self, ratio: float = HEDGE_BUDGET, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.requests = 0
+        self.fired = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.denied = 0
+
+    def on_request(self):
+        self.requests += 1
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            self.fired += 1
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> dict:
+        decided = self.hedge_wins + self.primary_wins
+        return {
+            "requests": self.requests,
+            "hedges_fired": self.fired,
+            "hedge_rate": round(self.fired / self.requests, 3) if self.requests else 0.0,
+            "denied_by_budget": self.denied,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins_after_hedge": self.primary_wins,
+            "hedge_win_rate": round(self.hedge_wins / decided, 3) if decided else 0.0,
+        }
+
+
+latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget()
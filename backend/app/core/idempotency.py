@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+# how long a finished reply can be replayed for a retried key, and how many keys are kept
+IDEMPOTENCY_TTL_S = float(os.getenv("IDEMPOTENCY_TTL_S", "600"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_KEY_MAX_LEN = 255
+
+
+class IdempotencyConflict(Exception):
+    """Same key reused for a different message"""
+
+
+def fingerprint(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode()).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "task", "expires")
+
+    def __init__(self, fingerprint: str, task: asyncio.Future):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.expires = time.monotonic() + IDEMPOTENCY_TTL_S
+
+
+class IdempotencyStore:
+    """
+    Results of keyed requests, per (user, key), kept for IDEMPOTENCY_TTL_S after they finish.
+    A retry that arrives while the first attempt is still running waits on the same task.
+    The work is shielded from the caller: a client that times out and retries
+    picks up the reply its first attempt is still producing.
+    Failed attempts are forgotten so a retry can try again, and so are results
+    the caller's replayable() turns down (a canned fallback that tells the user to retry).
+    """
+    def __init__(self, ttl_s: float = IDEMPOTENCY_TTL_S, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl_s = ttl_s
+        self.max_keys = max_keys
+        self.entries = OrderedDict()
+        self.started = 0
+        self.joined = 0
+        self.replayed = 0
+        self.conflicts = 0
+        self.evicted = 0
+
+    def _purge(self):
+        now = time.monotonic()
+        while self.entries:
+            slot, entry = next(iter(self.entries.items()))
+            if entry.expires > now and len(self.entries) <= self.max_keys:
+                break
+            del self.entries[slot]
+            if entry.expires > now:
+                self.evicted += 1
+
+    def _settled(self, slot: tuple, entry: _Entry, replayable: Optional[Callable]):
+        def done(task: asyncio.Future):
+            if (task.cancelled() or task.exception() is not None
+                    or (replayable is not None and not replayable(task.result()))):
+                if self.entries.get(slot) is entry:
+                    del self.entries[slot]
+            else:
+                entry.expires = time.monotonic() + self.ttl_s
+        return done
+
+    async def run(self, user_id: str, key: str, fingerprint: str, work: Callable[[], Awaitable],
+                  replayable: Optional[Callable] = None) -> tuple:
+        """(result, replayed) - replayed is True when an earlier request with this key did the work"""
+        self._purge()
+        slot = (user_id, key)
+        entry = self.entries.get(slot)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflict(f"Idempotency-Key {key!r} was already used for a different message")
+            if entry.task.done():
+                self.replayed += 1
+            else:
+                self.joined += 1
+            return await asyncio.shield(entry.task), True
+
+        entry = _Entry(fingerprint, asyncio.ensure_future(work()))
+        entry.task.add_done_callback(self._settled(slot, entry, replayable))
+        self.entries[slot] = entry
+        self.started += 1
+        return await asyncio.shield(entry.task), False
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self.entries),
+            "in_flight": sum(1 for e in self.entries.values() if not e.task.done()),
+            "started": self.started,
+            "joined_in_flight": self.joined,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+            "evicted": self.evicted,
+            "ttl_s": self.ttl_s,
+        }
+
+
+idempotency_store = IdempotencyStore()
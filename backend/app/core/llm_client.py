@@ -1,12 +1,26 @@
 import os
+import json
+import time
 import httpx
 import asyncio
-from datetime import datetime, timedelta
-from typing import Optional
+import logging
+from typing import Optional, Callable, Awaitable
 from dotenv import load_dotenv
+from app.core.quota_ledger import QuotaLedger, QuotaExceeded
+from app.core.message_analysis import analyze_message
+from app.core.deadline import Deadline, DeadlineExceeded, SEARCH_MIN_BUDGET_S, GENERATE_RESERVE_S
+from app.core.fair_share import (
+    FAIR_SHARE_ENABLED, ClientShare, ClientThrottled, FairQueue, fair_share
+)
+from app.core.model_tiers import model_for, tier_stats
+from app.core.hedging import (
+    HEDGE_ENABLED, HEDGE_PROVIDER, HEDGE_MODEL, HEDGE_PERCENTILE, latency_tracker, hedge_budget
+)
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 PROVIDER = os.getenv("LLM_PROVIDER", "gemini").lower()
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
@@ -19,6 +33,7 @@ GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-exp")
 CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "claude-3-5-haiku-20241022")
 GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
 COHERE_MODEL = os.getenv("COHERE_MODEL", "command-r-08-2024")
+DEFAULT_MODELS = {"gemini": GEMINI_MODEL, "claude": CLAUDE_MODEL, "groq": GROQ_MODEL, "cohere": COHERE_MODEL}
 
 PROVIDER_LIMITS = {
     "gemini": {
@@ -47,94 +62,160 @@ PROVIDER_LIMITS = {
     }
 }
 #wasted my one day  credits of gemini just while testing so took a precaution
+# counts live in a shared sqlite ledger so every worker (and restarts) see the same budget
+ledger = QuotaLedger()
+# work dropped because the client went away, by the stage it was in at the time
+cancel_stats = {"turns": 0, "stages": {}, "provider_calls_saved": 0, "requests_released": 0, "tokens_released": 0}
+
+
+def record_cancel(stage: str):
+    cancel_stats["stages"][stage] = cancel_stats["stages"].get(stage, 0) + 1
+
+
+def release_reservation(reservation: dict, requests: int, tokens: int, provider: Optional[str] = None):
+    """Give quota a cancelled request never used back to the ledger"""
+    ledger.adjust(provider or PROVIDER, reservation, requests=-requests, tokens=-tokens)
+    cancel_stats["requests_released"] += requests
+    cancel_stats["tokens_released"] += tokens
+
+
+# fire-and-forget ledger writes, referenced until done so they can't be garbage collected mid-flight
+_releases = set()
+
+
+def release_in_background(reservation: dict, requests: int, tokens: int, provider: Optional[str] = None):
+    """release_reservation off the event loop - for cancel paths that must not block on sqlite"""
+    task = asyncio.ensure_future(asyncio.to_thread(release_reservation, reservation, requests, tokens, provider))
+    _releases.add(task)
+    task.add_done_callback(_releases.discard)
+
+
+class FallbackReply(str):
+    """Text STAN says when the provider gave no usable reply - not model output, not worth remembering"""
+
+
+class StreamInterrupted(Exception):
+    """The provider failed after part of the reply was already streamed - a fallback can't replace it"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars per token), good enough for budgeting"""
+    return max(1, len(text) // 4)
+
+
 class UsageTracker:
     """Track API usage to warn before hitting limits"""
-    def __init__(self):
-        self.daily_count = 0
-        self.minute_count = 0
-        self.last_reset = datetime.now()
-        self.minute_reset = datetime.now()
+    def __init__(self, ledger: QuotaLedger):
+        self.ledger = ledger
     
-    def log_request(self):
-        now = datetime.now()
-        
-        if (now - self.last_reset).days >= 1:
-            self.daily_count = 0
-            self.last_reset = now
-        
-        if (now - self.minute_reset).seconds >= 60:
-            self.minute_count = 0
-            self.minute_reset = now
-        
-        self.daily_count += 1
-        self.minute_count += 1
-        
+    def log_request(self, usage: dict):
         limits = PROVIDER_LIMITS.get(PROVIDER, {})
         rpd = limits.get("rpd", 1000)
-        rpm = limits.get("rpm", 10)
         
-        daily_remaining = rpd - self.daily_count
-        minute_remaining = rpm - self.minute_count
+        daily_used = usage["daily_used"]
+        daily_remaining = usage["daily_remaining"]
+        minute_remaining = usage["minute_remaining"]
         
-        if self.daily_count % 100 == 0:  
-            print(f"📊 Usage: {self.daily_count}/{rpd} requests today ({daily_remaining} left)")
+        if daily_used % 100 == 0:  
+            log.info(f"📊 Usage: {daily_used}/{rpd} requests today ({daily_remaining} left)",
+                     extra={"provider": PROVIDER, "daily_used": daily_used, "daily_remaining": daily_remaining})
         
         if daily_remaining < 50:
-            print(f"⚠️  WARNING: Only {daily_remaining} requests left today!")
+            log.warning(f"⚠️  Only {daily_remaining} requests left today!",
+                        extra={"provider": PROVIDER, "daily_remaining": daily_remaining, "sample": "near_limit"})
         
         if minute_remaining < 3:
-            print(f"⚠️  Near rate limit: {minute_remaining} requests left this minute")
+            log.warning(f"⚠️  Near rate limit: {minute_remaining} requests left this minute",
+                        extra={"provider": PROVIDER, "minute_remaining": minute_remaining, "sample": "near_limit"})
         
-        return {
-            "daily_used": self.daily_count,
-            "daily_remaining": daily_remaining,
-            "minute_remaining": minute_remaining
-        }
+        return usage
+    
+    def snapshot(self) -> dict:
+        limits = PROVIDER_LIMITS.get(PROVIDER, {})
+        usage = self.ledger.snapshot(PROVIDER)
+        usage.update({
+            "provider": PROVIDER,
+            "rpm": limits.get("rpm"),
+            "rpd": limits.get("rpd"),
+            "tpm": limits.get("tpm"),
+        })
+        return usage
 
-usage_tracker = UsageTracker()
+usage_tracker = UsageTracker(ledger)
 
 
 class RateLimiter:
-    """FIXED: Only wait when actually approaching limits"""
-    def __init__(self):
-        self.requests = []
-        self.lock = asyncio.Lock()
+    """
+    Reserve quota in the shared ledger, only waiting when the minute budget is used up.
+    Each client first waits on its own bucket, then the fair queue decides who gets the next slot.
+    """
+    def __init__(self, ledger: QuotaLedger):
+        self.ledger = ledger
+        self.queue = FairQueue()
     
-    async def acquire(self):
-        async with self.lock:
-            limits = PROVIDER_LIMITS.get(PROVIDER, {"rpm": 10})
-            max_requests = limits["rpm"]
-            
-            now = datetime.now()
-            self.requests = [t for t in self.requests 
-                           if now - t < timedelta(seconds=60)]
-            
-            if len(self.requests) < max_requests:
-                self.requests.append(now)
-                return True
-            
-            oldest = self.requests[0]
-            wait_time = (oldest + timedelta(seconds=60) - now).total_seconds()
-            
-            if wait_time > 0:
-                print(f"⏳ Rate limit reached, waiting {wait_time:.1f}s...")
-                await asyncio.sleep(wait_time + 0.2)
-                self.requests = [t for t in self.requests 
-                               if datetime.now() - t < timedelta(seconds=60)]
-            
-            self.requests.append(datetime.now())
-            return True
+    async def acquire(self, tokens: int = 0, deadline: Optional[Deadline] = None,
+                      client: Optional[ClientShare] = None) -> dict:
+        """
+        Returns the ledger reservation once a slot is free.
+        Raises QuotaExceeded straight away if the daily budget is gone,
+        ClientThrottled if the client is over its own rate for longer than the turn can wait, and
+        DeadlineExceeded if the wait would leave no time for the call itself.
+        """
+        limits = PROVIDER_LIMITS.get(PROVIDER, {"rpm": 10})
+        client = client or fair_share.client()
+        max_wait = deadline.budget(60, keep=GENERATE_RESERVE_S) if deadline else None
+        
+        if FAIR_SHARE_ENABLED:
+            await fair_share.throttle(client, max_wait)
+        
+        # the queue orders waiters in this worker, the ledger arbitrates between workers
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(
+                self.queue.acquire(client.client_id, client.weight if FAIR_SHARE_ENABLED else 1.0),
+                deadline.budget(60, keep=GENERATE_RESERVE_S) if deadline else None
+            )
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("timed out queueing for the rate limiter")
+        
+        try:
+            while True:
+                try:
+                    reserving = asyncio.ensure_future(asyncio.to_thread(self.ledger.try_reserve, PROVIDER, limits, tokens))
+                    try:
+                        reservation = await asyncio.shield(reserving)
+                    except asyncio.CancelledError:
+                        # the ledger write carries on in its thread - hand the slot back once it lands
+                        reserving.add_done_callback(lambda done: self._release_late(done, tokens))
+                        raise
+                    client.queue_wait_s += time.monotonic() - queued_at
+                    return reservation
+                except QuotaExceeded as e:
+                    if e.window == "day":
+                        raise
+                    wait = e.retry_after + 0.2
+                    if deadline and not deadline.allows(wait + GENERATE_RESERVE_S):
+                        raise DeadlineExceeded(f"rate limit wait of {wait:.1f}s exceeds the turn deadline", wait)
+                    log.info(f"⏳ Rate limit reached, waiting {e.retry_after:.1f}s...",
+                             extra={"provider": PROVIDER, "wait_s": round(wait, 2), "sample": "rate_wait"})
+                    await asyncio.sleep(wait)
+        finally:
+            self.queue.release()
+    
+    def _release_late(self, reserving: asyncio.Future, tokens: int):
+        if not reserving.cancelled() and reserving.exception() is None:
+            release_in_background(reserving.result(), 1, tokens)
 
-rate_limiter = RateLimiter()
+rate_limiter = RateLimiter(ledger)
 
 # prblem while searching via chatbot ,ex tell me about carlos sainz, naruto
-async def web_search(query: str, num_results: int = 3) -> str:  
+async def web_search(query: str, num_results: int = 3, timeout: float = 8.0) -> str:  
     """Search the web using Serper API"""
     if not SERPER_API_KEY:
         return ""
     
     try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
+        async with httpx.AsyncClient(timeout=timeout) as client:
             response = await client.post(
                 "https://google.serper.dev/search",
                 headers={
@@ -164,28 +245,49 @@ async def web_search(query: str, num_results: int = 3) -> str:
                 
             return ""
     except Exception as e:
-        print(f"[Search Error]: {e}")
+        log.warning(f"Search failed: {e}")
         return ""
 
 def needs_search(message: str) -> bool:
     """Check if message needs web search"""
-    message_lower = message.lower().strip()
-    
-    explicit_search = [
-        'do you know about', 'tell me about', 'what do you know about',
-        'have you heard of', 'info about', 'information about',
-        'explain', 'who is', 'what is', 'when was', 'where is', 'how did'
-    ]
-    
-    return any(phrase in message_lower for phrase in explicit_search)
+    return analyze_message(message).search_intent
 
 
-async def _call_gemini(prompt: str, max_tokens: int, temperature: float, timeout: int) -> str:
+# streaming callback: receives each piece of reply text as the provider sends it
+OnToken = Callable[[str], Awaitable[None]]
+
+async def _stream(client: httpx.AsyncClient, url: str, on_token: OnToken, extract, **request) -> Optional[str]:
+    """
+    POST a streaming request and hand every text delta to on_token.
+    Understands SSE ("data: {...}") and plain NDJSON lines; extract(event) pulls the text out of one event.
+    Returns the whole reply, or None on a 429 like the non-streaming calls.
+    """
+    parts = []
+    async with client.stream("POST", url, **request) as resp:
+        if resp.status_code == 429:
+            return None
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if line.startswith("data:"):
+                line = line[5:].strip()
+            if not line or line == "[DONE]":
+                continue
+            try:
+                text = extract(json.loads(line))
+            except (ValueError, AttributeError, IndexError):
+                continue
+            if text:
+                parts.append(text)
+                await on_token(text)
+    return "".join(parts).strip() or "Could you rephrase that?"
+
+async def _call_gemini(prompt: str, max_tokens: int, temperature: float, timeout: int,
+                       model: Optional[str] = None, on_token: Optional[OnToken] = None) -> str:
     """Call Gemini API"""
     if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY not set")
     
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model or GEMINI_MODEL}:generateContent"
     params = {"key": GEMINI_API_KEY}
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
@@ -207,6 +309,12 @@ async def _call_gemini(prompt: str, max_tokens: int, temperature: float, timeout
     }
     
     async with httpx.AsyncClient(timeout=timeout) as client:
+        if on_token:
+            return await _stream(
+                client, url.replace(":generateContent", ":streamGenerateContent"), on_token,
+                lambda e: ((e.get("candidates") or [{}])[0].get("content", {}).get("parts") or [{}])[0].get("text"),
+                params={**params, "alt": "sse"}, json=payload
+            )
         resp = await client.post(url, params=params, json=payload)
         
         if resp.status_code == 429:
@@ -224,7 +332,8 @@ async def _call_gemini(prompt: str, max_tokens: int, temperature: float, timeout
     
     return "Could you rephrase that?"
 
-async def _call_claude(prompt: str, max_tokens: int, temperature: float, timeout: int) -> str:
+async def _call_claude(prompt: str, max_tokens: int, temperature: float, timeout: int,
+                       model: Optional[str] = None, on_token: Optional[OnToken] = None) -> str:
     """Call Claude API"""
     if not ANTHROPIC_API_KEY:
         raise RuntimeError("ANTHROPIC_API_KEY not set")
@@ -236,13 +345,19 @@ async def _call_claude(prompt: str, max_tokens: int, temperature: float, timeout
         "content-type": "application/json"
     }
     payload = {
-        "model": CLAUDE_MODEL,
+        "model": model or CLAUDE_MODEL,
         "max_tokens": max_tokens,
         "temperature": temperature,
         "messages": [{"role": "user", "content": prompt}]
     }
     
     async with httpx.AsyncClient(timeout=timeout) as client:
+        if on_token:
+            return await _stream(
+                client, url, on_token,
+                lambda e: e.get("delta", {}).get("text") if e.get("type") == "content_block_delta" else None,
+                headers=headers, json={**payload, "stream": True}
+            )
         resp = await client.post(url, headers=headers, json=payload)
         
         if resp.status_code == 429:
@@ -256,7 +371,8 @@ async def _call_claude(prompt: str, max_tokens: int, temperature: float, timeout
     
     return "Could you rephrase that?"
 
-async def _call_groq(prompt: str, max_tokens: int, temperature: float, timeout: int) -> str:
+async def _call_groq(prompt: str, max_tokens: int, temperature: float, timeout: int,
+                     model: Optional[str] = None, on_token: Optional[OnToken] = None) -> str:
     """Call Groq API"""
     if not GROQ_API_KEY:
         raise RuntimeError("GROQ_API_KEY not set")
@@ -267,13 +383,19 @@ async def _call_groq(prompt: str, max_tokens: int, temperature: float, timeout:
         "Content-Type": "application/json"
     }
     payload = {
-        "model": GROQ_MODEL,
+        "model": model or GROQ_MODEL,
         "messages": [{"role": "user", "content": prompt}],
         "max_tokens": max_tokens,
         "temperature": temperature
     }
     
     async with httpx.AsyncClient(timeout=timeout) as client:
+        if on_token:
+            return await _stream(
+                client, url, on_token,
+                lambda e: (e.get("choices") or [{}])[0].get("delta", {}).get("content"),
+                headers=headers, json={**payload, "stream": True}
+            )
         resp = await client.post(url, headers=headers, json=payload)
         
         if resp.status_code == 429:
@@ -287,7 +409,8 @@ async def _call_groq(prompt: str, max_tokens: int, temperature: float, timeout:
     
     return "Could you rephrase that?"
 
-async def _call_cohere(prompt: str, max_tokens: int, temperature: float, timeout: int) -> str:
+async def _call_cohere(prompt: str, max_tokens: int, temperature: float, timeout: int,
+                       model: Optional[str] = None, on_token: Optional[OnToken] = None) -> str:
     """Call Cohere API"""
     if not COHERE_API_KEY:
         raise RuntimeError("COHERE_API_KEY not set")
@@ -298,13 +421,19 @@ async def _call_cohere(prompt: str, max_tokens: int, temperature: float, timeout
         "Content-Type": "application/json"
     }
     payload = {
-        "model": COHERE_MODEL,
+        "model": model or COHERE_MODEL,
         "message": prompt,
         "max_tokens": max_tokens,
         "temperature": temperature
     }
     
     async with httpx.AsyncClient(timeout=timeout) as client:
+        if on_token:
+            return await _stream(
+                client, url, on_token,
+                lambda e: e.get("text") if e.get("event_type") == "text-generation" else None,
+                headers=headers, json={**payload, "stream": True}
+            )
         resp = await client.post(url, headers=headers, json=payload)
         
         if resp.status_code == 429:
@@ -319,91 +448,243 @@ async def _call_cohere(prompt: str, max_tokens: int, temperature: float, timeout
     return "Could you rephrase that?"
 
 
+PROVIDER_FUNCS = {
+    "gemini": _call_gemini,
+    "claude": _call_claude,
+    "groq": _call_groq,
+    "cohere": _call_cohere
+}
+
+
+async def _timed_call(provider: str, prompt: str, max_tokens: int, temperature: float, timeout: int,
+                      model: Optional[str] = None, on_token: Optional[OnToken] = None) -> Optional[str]:
+    start = time.monotonic()
+    result = await PROVIDER_FUNCS[provider](prompt, max_tokens, temperature, timeout, model, on_token)
+    if result is not None:
+        latency_tracker.record(provider, time.monotonic() - start)
+    return result
+
+
+async def _call_hedged(prompt: str, max_tokens: int, temperature: float, timeout: int,
+                       model: Optional[str] = None) -> Optional[str]:
+    """
+    Call the primary provider; if it's slower than its usual HEDGE_PERCENTILE latency,
+    send the same prompt to HEDGE_PROVIDER/HEDGE_MODEL too and take whichever answers first.
+    """
+    primary = asyncio.create_task(_timed_call(PROVIDER, prompt, max_tokens, temperature, timeout, model))
+    hedge = None
+    hedge_reservation = None
+    hedge_settled = False
+    hedge_budget.on_request()
+    
+    try:
+        delay = latency_tracker.percentile(PROVIDER, HEDGE_PERCENTILE)
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not hedge_budget.try_spend():
+            return await primary
+        
+        hedge_provider = HEDGE_PROVIDER or PROVIDER
+        try:
+            hedge_reservation = await asyncio.to_thread(
+                ledger.try_reserve, hedge_provider, PROVIDER_LIMITS.get(hedge_provider, {}),
+                estimate_tokens(prompt) + max_tokens
+            )
+        except QuotaExceeded:
+            # no quota to spare for a duplicate, just keep waiting on the primary
+            return await primary
+        
+        log.info(f"🏁 {PROVIDER} slower than {delay:.1f}s, hedging to {hedge_provider}",
+                 extra={"provider": PROVIDER, "hedge_provider": hedge_provider})
+        hedge = asyncio.create_task(
+            _timed_call(hedge_provider, prompt, max_tokens, temperature, timeout, HEDGE_MODEL or None)
+        )
+        
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result() is not None:
+                    if task is hedge:
+                        hedge_budget.hedge_wins += 1
+                        # settle the hedge's worst-case charge with the reply it actually sent
+                        ledger.adjust(hedge_provider, hedge_reservation,
+                                      tokens=estimate_tokens(task.result()) - max_tokens)
+                        hedge_settled = True
+                    else:
+                        hedge_budget.primary_wins += 1
+                    return task.result()
+        
+        # both failed - report it the way the primary failed
+        return primary.result()
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+        if hedge_reservation is not None and not hedge_settled:
+            # lost, failed or cancelled: the prompt went out, the reply budget comes back
+            release_in_background(hedge_reservation, 0, max_tokens, hedge_provider)
+
+
 async def generate(
     prompt: str,
     user_message: str = "",
     max_tokens: int = 350,
     temperature: float = 0.9,
     timeout_seconds: int = 30,
-    enable_search: bool = True
+    enable_search: bool = True,
+    search_intent: Optional[bool] = None,
+    deadline: Optional[Deadline] = None,
+    user_id: str = "",
+    api_key: Optional[str] = None,
+    on_token: Optional[OnToken] = None,
+    model: Optional[str] = None,
+    tier: Optional[str] = None,
+    batch: bool = False
 ) -> str:
     """
     Generate text using configured LLM provider.
     Automatically tracks usage and switches providers if needed.
+    Pass search_intent from the turn's MessageAnalysis to skip re-scanning user_message.
+    With a deadline every stage (search, rate-limit wait, call, retry) fits in what's left of it.
+    user_id / api_key pick the client whose fair share of the provider budget this request uses,
+    batch puts it in that client's separate batch bucket.
+    Raises ClientThrottled, QuotaExceeded (daily budget gone) or DeadlineExceeded when the request
+    can't get a provider slot - there is no reply then, the caller decides what the user sees.
+    With on_token the reply is streamed from the provider piece by piece (no hedging then);
+    a failure after the first piece raises StreamInterrupted.
+    model overrides the provider's default *_MODEL for this call.
+    tier ("small" / "large", see model_tiers) picks the model when none is given.
     """
     
     provider_info = PROVIDER_LIMITS.get(PROVIDER, {})
     provider_name = provider_info.get("name", PROVIDER)
     
     search_results = ""
-    if enable_search and user_message and needs_search(user_message):
-        print(f" Searching: {user_message}")
-        search_results = await web_search(user_message)
+    if search_intent is None:
+        search_intent = bool(user_message) and needs_search(user_message)
+    
+    if enable_search and user_message and search_intent and deadline and not deadline.allows(SEARCH_MIN_BUDGET_S):
+        log.info(f"⏱️  Skipping search, only {deadline.remaining():.1f}s left", extra={"sample": "deadline"})
+    elif enable_search and user_message and search_intent:
+        log.info(f"Searching: {user_message[:80]}", extra={"sample": "search"})
+        search_timeout = deadline.budget(8.0, keep=GENERATE_RESERVE_S) if deadline else 8.0
+        try:
+            search_results = await web_search(user_message, timeout=search_timeout)
+        except asyncio.CancelledError:
+            record_cancel("search")
+            cancel_stats["provider_calls_saved"] += 1
+            raise
         
         if search_results:
             prompt = prompt.replace("STAN:", f"{search_results}\nSTAN:")
     
-    usage = usage_tracker.log_request()
+    if PROVIDER not in PROVIDER_FUNCS:
+        raise RuntimeError(f"Unknown provider: {PROVIDER}")
     
-    await rate_limiter.acquire()
+    # a prompt carrying search results is no longer a quick one; and without a small model
+    # the turn runs on the default one, so it's counted there
+    if tier == "small" and (search_results or not model_for(PROVIDER, "small")):
+        tier = "large"
+    if model is None and tier:
+        model = model_for(PROVIDER, tier)
     
-    provider_func = {
-        "gemini": _call_gemini,
-        "claude": _call_claude,
-        "groq": _call_groq,
-        "cohere": _call_cohere
-    }.get(PROVIDER)
+    # budget the worst case up front, settle with the real size once we have a reply
+    reserved_tokens = estimate_tokens(prompt) + max_tokens
+    client = fair_share.client(user_id, api_key, batch)
+    try:
+        reservation = await rate_limiter.acquire(tokens=reserved_tokens, deadline=deadline, client=client)
+    except ClientThrottled as e:
+        log.info(f"🚦 {e}", extra={"client": client.client_id, "sample": "throttle"})
+        raise
+    except QuotaExceeded:
+        log.warning(f"⚠️  {provider_name} daily quota used up, not calling the API", extra={"sample": "near_limit"})
+        raise
+    except DeadlineExceeded as e:
+        log.info(f"⏱️  {e}", extra={"sample": "deadline"})
+        raise
+    except asyncio.CancelledError:
+        record_cancel("rate_limit")
+        cancel_stats["provider_calls_saved"] += 1
+        raise
     
-    if not provider_func:
-        raise RuntimeError(f"Unknown provider: {PROVIDER}")
+    usage_tracker.log_request(reservation)
     
-    for attempt in range(2):
-        try:
-            result = await provider_func(prompt, max_tokens, temperature, timeout_seconds)
+    streamed = 0
+    streamed_chars = 0
+    async def relay(text: str):
+        nonlocal streamed, streamed_chars
+        streamed += 1
+        streamed_chars += len(text)
+        await on_token(text)
+    
+    try:
+        for attempt in range(2):
+            call_timeout = deadline.budget(timeout_seconds) if deadline else timeout_seconds
+            if call_timeout <= 0:
+                return FallbackReply("Taking too long to think... try asking again!")
+            # only retry if there's still a realistic amount of time left for it
+            can_retry = attempt == 0 and (deadline is None or deadline.allows(GENERATE_RESERVE_S + 1))
+        
+            try:
+                call_started = time.monotonic()
+                if on_token:
+                    result = await _timed_call(PROVIDER, prompt, max_tokens, temperature, call_timeout, model, relay)
+                elif HEDGE_ENABLED:
+                    result = await _call_hedged(prompt, max_tokens, temperature, call_timeout, model)
+                else:
+                    result = await _timed_call(PROVIDER, prompt, max_tokens, temperature, call_timeout, model)
             
-            if result is None:  
-                if attempt == 0:
-                    print("⏳ Rate limit hit from API, waiting 5s...")
-                    await asyncio.sleep(5)
-                    continue
-                return "Whoa, slow down a bit! Give me a sec and try again 😅"
+                if result is None:  
+                    ledger.mark_minute_full(PROVIDER, provider_info.get("rpm", 10))
+                    if can_retry and (deadline is None or deadline.allows(5 + GENERATE_RESERVE_S)):
+                        log.warning("⏳ Rate limit hit from API, waiting 5s...", extra={"provider": PROVIDER})
+                        await asyncio.sleep(5)
+                        continue
+                    return FallbackReply("Whoa, slow down a bit! Give me a sec and try again 😅")
             
-            return result
+                ledger.adjust(PROVIDER, reservation, tokens=estimate_tokens(result) - max_tokens)
+                client.tokens_used += reserved_tokens - max_tokens + estimate_tokens(result)
+                tier_stats.record(tier or "default", model or DEFAULT_MODELS.get(PROVIDER, PROVIDER),
+                                  time.monotonic() - call_started, estimate_tokens(prompt), estimate_tokens(result))
+                return result
         
-        except httpx.TimeoutException:
-            if attempt == 0:
-                print(" Timeout, retrying once...")
-                await asyncio.sleep(1)
-                continue
-            return "Taking too long to think... try asking again!"
+            except httpx.TimeoutException:
+                # half a reply already went out to the client, starting over would repeat it
+                if streamed:
+                    raise StreamInterrupted(f"{provider_name} timed out mid-reply")
+                if can_retry and (deadline is None or deadline.allows(1 + GENERATE_RESERVE_S)):
+                    log.warning("Timeout, retrying once...", extra={"provider": PROVIDER, "model": model})
+                    await asyncio.sleep(1)
+                    continue
+                return FallbackReply("Taking too long to think... try asking again!")
         
-        except Exception as e:
-            print(f" Error with {provider_name}: {e}")
-            if attempt == 0:
-                await asyncio.sleep(1)
-                continue
-            return "Oops, something went wrong on my end. Try again?"
+            except Exception as e:
+                log.error(f"Error with {provider_name}: {e}", extra={"provider": PROVIDER, "model": model})
+                if streamed:
+                    raise StreamInterrupted(f"{provider_name} failed mid-reply") from e
+                if can_retry:
+                    await asyncio.sleep(1)
+                    continue
+                return FallbackReply("Oops, something went wrong on my end. Try again?")
+    
+        return FallbackReply("Having some trouble right now. Give me a moment!")
     
-    return "Having some trouble right now. Give me a moment!"
+    except asyncio.CancelledError:
+        # the provider already has the prompt, only the unanswered part of the reply budget comes back
+        record_cancel("provider_call")
+        release_in_background(reservation, 0, max(0, max_tokens - streamed_chars // 4))
+        raise
 
 
-def print_provider_info():
-    """Print current provider info on startup"""
+def log_provider_info():
+    """Log the current provider on startup"""
     provider_info = PROVIDER_LIMITS.get(PROVIDER, {})
-    name = provider_info.get("name", PROVIDER)
-    rpm = provider_info.get("rpm", "Unknown")
-    rpd = provider_info.get("rpd", "Unknown")
-    
-    print(f"""
-╔══════════════════════════════════════╗
-║     LLM PROVIDER CONFIGURATION       ║
-╠══════════════════════════════════════╣
-║ Provider: {name:<26} ║
-║ Limits:   {rpm} req/min, {rpd} req/day   ║
-║ Model:    {PROVIDER}                        ║
-╚══════════════════════════════════════╝
-    """)
-
-
-print_provider_info()
+    log.info(
+        f"LLM provider: {provider_info.get('name', PROVIDER)} "
+        f"({provider_info.get('rpm', 'Unknown')} req/min, {provider_info.get('rpd', 'Unknown')} req/day)",
+        extra={"provider": PROVIDER, "model": DEFAULT_MODELS.get(PROVIDER), "rpm": provider_info.get("rpm"),
+               "rpd": provider_info.get("rpd")}
+    )
+
+
 #took groq just for testing but its free tier generousity made me a fan so used this only!!
\ No newline at end of file
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import uuid
+import queue
+import random
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text | json
+# records waiting for the writer thread; past this they are dropped instead of blocking a request
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# share of the lines that can repeat on every request which get written, per sample key; errors always are
+DEFAULT_LOG_SAMPLE_RATES = {"search": 0.1, "rate_wait": 0.1, "near_limit": 0.1, "throttle": 0.1, "deadline": 0.1}
+LOG_SAMPLE_RATES = {**DEFAULT_LOG_SAMPLE_RATES, **json.loads(os.getenv("LOG_SAMPLE_RATES", "{}"))}
+
+request_id = contextvars.ContextVar("request_id", default="-")
+
+# LogRecord's own attributes, everything else on a record came in through extra=
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id", "sample"}
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class _Context(logging.Filter):
+    """Stamps each record with the current request's correlation id and applies sampling"""
+    def __init__(self):
+        super().__init__()
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        key = getattr(record, "sample", None)
+        if key and record.levelno < logging.ERROR and random.random() >= LOG_SAMPLE_RATES.get(key, 1.0):
+            self.sampled_out += 1
+            return False
+        return True
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the writer thread; a full queue drops the record, it never waits"""
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.queued = 0
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RESERVED})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_handler: Optional[_NonBlockingQueueHandler] = None
+_context: Optional[_Context] = None
+_listener: Optional[QueueListener] = None
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """
+    Route the app's loggers through a queue to one writer thread, so a slow stdout
+    never holds up the event loop. Called once at startup; calling it again is a no-op.
+    """
+    global _handler, _context, _listener
+    if _listener is not None:
+        return
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(
+        "%(asctime)s %(levelname)-7s [%(request_id)s] %(name)s: %(message)s"
+    ))
+    _context = _Context()
+    _handler = _NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    # the filter runs in the caller, where the request's contextvars are visible
+    _handler.addFilter(_context)
+    app_logger = logging.getLogger("app")
+    app_logger.setLevel(level)
+    app_logger.addHandler(_handler)
+    app_logger.propagate = False
+    _listener = QueueListener(_handler.queue, writer, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Write out whatever is still queued"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        logging.getLogger("app").removeHandler(_handler)
+        logging.getLogger("app").propagate = True
+        _listener = None
+
+
+def log_stats() -> dict:
+    return {
+        "level": logging.getLevelName(logging.getLogger("app").getEffectiveLevel()),
+        "format": LOG_FORMAT,
+        "queued": _handler.queued if _handler else 0,
+        "backlog": _handler.queue.qsize() if _handler else 0,
+        "dropped_queue_full": _handler.dropped if _handler else 0,
+        "sampled_out": _context.sampled_out if _context else 0,
+        "sample_rates": LOG_SAMPLE_RATES,
+    }
+
+
+class CorrelationIdMiddleware:
+    """
+    Plain ASGI middleware (BaseHTTPMiddleware would swallow the disconnect the chat routes
+    listen for): takes X-Request-ID from the client or makes one, binds it for every log
+    line of the request and echoes it back on the response.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        incoming = dict(scope.get("headers") or []).get(b"x-request-id", b"").decode("latin-1")
+        rid = incoming[:64] or new_request_id()
+        token = request_id.set(rid)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", rid.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id if scope["type"] == "http" else send)
+        finally:
+            request_id.reset(token)
@@ -0,0 +1,221 @@
+import os
+import json
+import logging
+import time
+import asyncio
+import numpy as np
+from datetime import datetime
+from contextlib import contextmanager
+from app.db.vector_store import (
+    list_user_ids, get_all_memories, delete_memories, update_memory_metadata
+)
+from app.core.memory_manager import FACT_PATTERN, SINGLE_VALUED_FACT
+from app.core.logging_setup import configure_logging
+
+CONSOLIDATION_ENABLED = os.getenv("CONSOLIDATION_ENABLED", "true").lower() == "true"
+CONSOLIDATION_INTERVAL_S = float(os.getenv("CONSOLIDATION_INTERVAL_S", "3600"))
+CONSOLIDATION_PAUSE_S = float(os.getenv("CONSOLIDATION_PAUSE_S", "0.2"))
+CONSOLIDATION_USERS_PER_PASS = int(os.getenv("CONSOLIDATION_USERS_PER_PASS", "200"))
+CONSOLIDATION_SIMILARITY = float(os.getenv("CONSOLIDATION_SIMILARITY", "0.92"))
+CONSOLIDATION_STATE_PATH = os.getenv("CONSOLIDATION_STATE_PATH", "./consolidation_state.json")
+
+log = logging.getLogger(__name__)
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class ConsolidationState:
+    """
+    Small JSON file remembering, per user, how far we've consolidated.
+    Saved after every user so a killed pass picks up where it stopped.
+    """
+    def __init__(self, path: str = CONSOLIDATION_STATE_PATH):
+        self.path = path
+        self.data = {"users": {}, "pending": [], "last_report": []}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.data.update(json.load(f))
+            except (OSError, ValueError):
+                log.warning(f"⚠️  Could not read {path}, starting consolidation from scratch")
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+
+def consolidate_user(user_id: str, user_state: dict, similarity: float = CONSOLIDATION_SIMILARITY) -> dict:
+    """
+    Merge near-duplicate memories and drop superseded facts for one user.
+    Only memories newer than the user's watermark are compared against the rest,
+    so repeated passes over an unchanged index are nearly free.
+    """
+    data = get_all_memories(user_id, include_embeddings=True)
+    ids = data.get("ids") or []
+    before = len(ids)
+    if before == 0:
+        return {"user_id": user_id, "before": 0, "after": 0, "skipped": True}
+
+    docs = data["documents"]
+    metas = [m or {} for m in data["metadatas"]]
+    stamps = [m.get("timestamp", "") for m in metas]
+    newest = max(stamps)
+
+    watermark = user_state.get("watermark", "")
+    if user_state.get("count") == before and watermark >= newest:
+        return {"user_id": user_id, "before": before, "after": before, "skipped": True}
+
+    alive = np.ones(before, dtype=bool)
+    merged = {}
+
+    # 1. superseded facts: keep the newest "Favorite club: ..." etc.
+    latest = {}
+    for i in sorted(range(before), key=lambda i: stamps[i], reverse=True):
+        match = SINGLE_VALUED_FACT.match(docs[i])
+        if not match:
+            continue
+        key = match.group(1).lower()
+        if key in latest:
+            alive[i] = False
+        else:
+            latest[key] = i
+
+    # 2. near-duplicates of anything new since the last pass
+    emb = np.asarray(data["embeddings"], dtype=np.float32)
+    emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+    is_fact = np.array([bool(FACT_PATTERN.match(d)) for d in docs])
+    norm_docs = [_normalize(d) for d in docs]
+
+    fresh = [i for i in range(before) if stamps[i] > watermark or not watermark]
+    for i in sorted(fresh, key=lambda i: stamps[i], reverse=True):
+        if not alive[i]:
+            continue
+        sims = emb @ emb[i]
+        cluster = np.flatnonzero(alive & (sims >= similarity))
+        # two different facts ("Loves: Naruto" / "Loves: Bleach") embed close, never merge those
+        cluster = [
+            j for j in cluster
+            if j == i or not (is_fact[i] and is_fact[j]) or norm_docs[i] == norm_docs[j]
+        ]
+        if len(cluster) < 2:
+            continue
+
+        # canonical = structured fact if there is one, else the newest message
+        keep = max(cluster, key=lambda j: (is_fact[j], stamps[j]))
+        for j in cluster:
+            if j != keep:
+                alive[j] = False
+        merged[keep] = merged.get(keep, 0) + len(cluster) - 1
+
+    removed = [ids[i] for i in np.flatnonzero(~alive)]
+    delete_memories(user_id, removed)
+
+    survivors = [k for k in merged if alive[k]]
+    if survivors:
+        update_memory_metadata(
+            user_id,
+            [ids[k] for k in survivors],
+            [{**metas[k], "merged_count": int(metas[k].get("merged_count", 0)) + merged[k]} for k in survivors]
+        )
+
+    after = int(alive.sum())
+    user_state["watermark"] = newest
+    user_state["count"] = after
+    return {"user_id": user_id, "before": before, "after": after, "skipped": False}
+
+
+def run_consolidation_pass(state: ConsolidationState = None, max_users: int = CONSOLIDATION_USERS_PER_PASS,
+                           pause_s: float = CONSOLIDATION_PAUSE_S) -> list:
+    """
+    One throttled sweep over (at most max_users) users.
+    Unfinished users stay in state["pending"] for the next pass.
+    """
+    state = state or ConsolidationState()
+    if not state.data["pending"]:
+        state.data["pending"] = list_user_ids()
+
+    report = []
+    for _ in range(min(max_users, len(state.data["pending"]))):
+        user_id = state.data["pending"][0]
+        user_state = state.data["users"].setdefault(user_id, {})
+        try:
+            result = consolidate_user(user_id, user_state)
+        except Exception as e:
+            log.exception(f"Consolidation failed for {user_id}: {e}")
+            result = {"user_id": user_id, "error": str(e)}
+
+        state.data["pending"].pop(0)
+        state.save()
+
+        if not result.get("skipped"):
+            report.append(result)
+            if "error" not in result and result["before"] != result["after"]:
+                shrink = 100 * (result["before"] - result["after"]) / result["before"]
+                log.info(f"🧹 {user_id}: {result['before']} → {result['after']} memories (-{shrink:.0f}%)")
+
+        # stay out of the way of foreground chroma traffic
+        time.sleep(pause_s)
+
+    if report:
+        state.data["last_report"] = report
+    state.data["last_run"] = datetime.now().isoformat()
+    state.save()
+    return report
+
+
+@contextmanager
+def _single_worker_lock(path: str):
+    """Only one worker process runs a pass at a time; the others just skip it"""
+    try:
+        import fcntl
+    except ImportError:  # windows dev box, single worker anyway
+        yield True
+        return
+
+    with open(path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_locked_pass() -> list:
+    with _single_worker_lock(f"{CONSOLIDATION_STATE_PATH}.lock") as acquired:
+        if not acquired:
+            return []
+        # re-read state, another worker may have advanced it since our last pass
+        return run_consolidation_pass(ConsolidationState())
+
+
+async def consolidation_loop(interval_s: float = CONSOLIDATION_INTERVAL_S):
+    """Background task: run a pass every interval_s in a worker thread"""
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            await asyncio.to_thread(run_locked_pass)
+        except Exception as e:
+            log.exception(f"Consolidation pass failed: {e}")
+
+
+def last_report() -> dict:
+    state = ConsolidationState()
+    return {
+        "last_run": state.data.get("last_run"),
+        "pending_users": len(state.data["pending"]),
+        "report": state.data["last_report"],
+    }
+
+
+if __name__ == "__main__":
+    configure_logging()
+    for row in run_locked_pass():
+        print(row)
@@ -1,35 +1,97 @@
-from app.db.vector_store import add_memory, retrieve_memories
+from app.db.vector_store import (
+    add_memory, add_memories, query_memories, embed_texts, memory_version, purge_user, has_untagged_memories
+)
 from app.core.prompt_templates import should_save_to_memory
+from app.core.message_analysis import MessageAnalysis, analyze_message, extract_fact
+from app.core.reranker import rerank, ages_in_seconds, IMPORTANCE, RERANK_OVERFETCH
+from app.core.recall_cache import RecallCache, RECALL_CACHE_ENABLED
+from app.db.memory_filters import RecallFilter
 from datetime import datetime
 import re
 
+# everything _extract_key_info can produce, the rest are verbatim messages
+FACT_PATTERN = re.compile(
+    r"^(User's name|Favorite [\w ]+|Studies|Works|Lives in|From|Loves anime|Likes anime|"
+    r"Into anime|Supports|Fan of|Loves|Likes|Dislikes): (.+)$"
+)
+# facts a user only has one of at a time - a newer one replaces the old one
+SINGLE_VALUED_FACT = re.compile(r"^(User's name|Favorite [\w ]+|Studies|Works|Lives in|From): (.+)$")
+
+
+# FACT_PATTERN label -> the fact_type stored with the memory, so recall can filter on it
+FACT_TYPES = {
+    "User's name": "name", "Studies": "studies", "Works": "work", "Lives in": "location", "From": "location",
+    "Loves anime": "anime", "Likes anime": "anime", "Into anime": "anime", "Supports": "sports",
+    "Fan of": "interest", "Loves": "interest", "Likes": "interest", "Dislikes": "dislike",
+}
+
+
+def fact_type_of(text: str, role: str = "user") -> str:
+    """name | favorite | studies | work | location | anime | sports | interest | dislike | message | assistant"""
+    if role == "assistant":
+        return "assistant"
+    match = FACT_PATTERN.match(text)
+    if not match:
+        return "message"
+    label = match.group(1)
+    return "favorite" if label.startswith("Favorite") else FACT_TYPES.get(label, "message")
+
+
+def memory_importance(text: str, metadata: dict) -> float:
+    """Importance weight of a stored memory for re-ranking"""
+    if (metadata or {}).get("role") == "assistant":
+        return IMPORTANCE["assistant"]
+    if text.startswith("User's name:"):
+        return IMPORTANCE["name"]
+    if FACT_PATTERN.match(text):
+        return IMPORTANCE["fact"]
+    return IMPORTANCE["message"]
+
+
 class MemoryManager:
     def __init__(self):
         self.short_term_buffer = {}  
         self.max_buffer_size = 8  
+        self.recall_cache = RecallCache() if RECALL_CACHE_ENABLED else None
     
-    def save_interaction(self, user_id: str, message: str, turn_id: int, is_user: bool = True):
+    def save_interaction(self, user_id: str, message: str, turn_id: int, is_user: bool = True,
+                         analysis: MessageAnalysis = None, fact_embedding=None, pending: list = None):
         """
         Intelligently save messages.
         Short-term: Everything (for flow)
         Long-term: Only meaningful content
+        With pending, the long-term write is appended there for save_pending instead of stored now.
         """
         self._add_to_buffer(user_id, message, is_user)
         
-        if should_save_to_memory(message, is_user):
-            clean_message = self._extract_key_info(message, is_user)
+        if not is_user:
+            return
+        
+        analysis = analysis or analyze_message(message, is_user)
+        if should_save_to_memory(message, is_user, analysis):
+            clean_message = analysis.fact
             
             if clean_message:
                 role = "user" if is_user else "assistant"
-                add_memory(
-                    user_id=user_id,
-                    text=clean_message,
-                    metadata={
-                        "turn_id": turn_id,
-                        "role": role,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                )
+                now = datetime.now()
+                metadata = {
+                    "turn_id": turn_id,
+                    "role": role,
+                    "timestamp": now.isoformat(),
+                    # numeric / categorical copies the stores can filter on
+                    "ts": now.timestamp(),
+                    "fact_type": fact_type_of(clean_message, role)
+                }
+                if pending is not None:
+                    pending.append((clean_message, metadata, fact_embedding))
+                    return
+                add_memory(user_id=user_id, text=clean_message, metadata=metadata, embedding=fact_embedding)
+
+    def save_pending(self, user_id: str, pending: list):
+        """Store writes collected by save_interaction(pending=...) in one go"""
+        if pending:
+            texts, metadatas, embeddings = zip(*pending)
+            add_memories(user_id, list(texts), list(metadatas), list(embeddings))
     # every second message made by limit getting reached so started saving messages which where given by user only
     def _extract_key_info(self, message: str, is_user: bool) -> str:
         """
@@ -38,83 +100,7 @@ class MemoryManager:
         if not is_user:
             return ""
         
-        message_lower = message.lower().strip()
-        
-        name_patterns = [
-            r"my name is (\w+)",
-            r"i'?m (\w+)",
-            r"call me (\w+)",
-            r"i am (\w+)"
-        ]
-        for pattern in name_patterns:
-            match = re.search(pattern, message_lower)
-            if match and len(match.group(1)) > 2:  
-                name = match.group(1).title()
-                if name not in ['Into', 'From', 'Love', 'Like']:  
-                    return f"User's name: {name}"
-        
-        anime_patterns = [
-            (r"i love (?:watching |the anime )?([^,.!?]+?)(?:\s+anime|\s+show)?(?:\.|,|$)", "Loves anime: {0}"),
-            (r"i like (?:watching |the anime )?([^,.!?]+?)(?:\s+anime|\s+show)?(?:\.|,|$)", "Likes anime: {0}"),
-            (r"i'?m (?:really )?into (?:the anime )?([^,.!?]+?)(?:\s+anime)?(?:\.|,|$)", "Into anime: {0}"),
-            (r"my fav(?:orite)? anime is ([^,.!?]+)", "Favorite anime: {0}"),
-        ]
-        
-        for pattern, template in anime_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                content = match.group(1).strip()
-                
-                if len(content) > 2 and content not in ['it', 'that', 'this', 'anime']:
-                    return template.format(content.title())
-        
-        sports_patterns = [
-            (r"my fav(?:orite)? (?:football |soccer )?(?:team|club) is ([^,.!?]+)", "Favorite club: {0}"),
-            (r"i support ([^,.!?]+?)(?:\s+(?:fc|football club))?(?:\.|,|$)", "Supports: {0}"),
-            (r"i'?m a(?: big)? ([^,.!?]+?) fan", "Fan of: {0}"),
-        ]
-        
-        for pattern, template in sports_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                content = match.group(1).strip()
-                if len(content) > 2:
-                    return template.format(content.title())
-        
-        
-        general_patterns = [
-            (r"my fav(?:orite)? (\w+) is ([^,.!?]+)", "Favorite {0}: {1}"),
-            (r"i love ([^,.!?]+?)(?:\.|,|$)", "Loves: {0}"),
-            (r"i like ([^,.!?]+?)(?:\.|,|$)", "Likes: {0}"),
-            (r"i hate ([^,.!?]+?)(?:\.|,|$)", "Dislikes: {0}"),
-        ]
-        
-        for pattern, template in general_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                if "{0}" in template and "{1}" in template:
-                    return template.format(match.group(1).strip(), match.group(2).strip().title())
-                else:
-                    content = match.group(1).strip()
-                    if len(content) > 2:
-                        return template.format(content.title())
-        
-        info_patterns = [
-            (r"i (?:study|am studying) ([^,.!?]+)", "Studies: {0}"),
-            (r"i (?:work|am working) (?:as |at )?([^,.!?]+)", "Works: {0}"),
-            (r"i live in ([^,.!?]+)", "Lives in: {0}"),
-            (r"i'?m from ([^,.!?]+)", "From: {0}"),
-        ]
-        
-        for pattern, template in info_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                return template.format(match.group(1).strip().title())
-        
-        if len(message.split()) >= 5:
-            return message
-        
-        return ""
+        return extract_fact(message, message.lower().strip())
     
     def _add_to_buffer(self, user_id: str, message: str, is_user: bool):
         """Maintain rolling buffer of recent messages."""
@@ -135,28 +121,77 @@ class MemoryManager:
         recent = self.short_term_buffer[user_id][-6:]
         return "\n".join(recent)
     
-    def recall_context(self, user_id: str, query: str, top_k: int = 4) -> str:
+    def last_reply(self, user_id: str) -> str:
+        """STAN's most recent line in the buffer, if the conversation ended on one"""
+        buffer = self.short_term_buffer.get(user_id)
+        if buffer and buffer[-1].startswith("STAN: "):
+            return buffer[-1][len("STAN: "):]
+        return ""
+    
+    def recall_context(self, user_id: str, query: str, top_k: int = 4, query_embedding=None,
+                       filters: RecallFilter = None) -> str:
         """
         Retrieve the most relevant memories.
+        Over-fetches from chroma, then re-ranks by similarity + recency + importance.
+        Near-repeat queries are answered from the recall cache until the user's memories change.
+        filters (role / time range / fact type) are applied by the store itself and skip the cache.
         Returns clean, factual information.
         """
-        memories = retrieve_memories(user_id, query, top_k)
+        if filters is not None:
+            result = self._recall_uncached(user_id, query, top_k, query_embedding, filters)
+            # a fact-type filter finding nothing (e.g. memories not tagged yet) falls back to plain recall.
+            # So does a time range while some memories still lack the numeric ts (chroma can't range over
+            # the ISO timestamp) - until maintenance tags them, an empty result proves nothing
+            if result or (filters.is_time_scoped() and not has_untagged_memories(user_id)):
+                return result
+        
+        if self.recall_cache is not None:
+            if query_embedding is None:
+                query_embedding = embed_texts([query])[0]
+            version = memory_version(user_id)
+            cached = self.recall_cache.get(user_id, query_embedding, top_k, version)
+            if cached is not None:
+                return cached
+        
+        result = self._recall_uncached(user_id, query, top_k, query_embedding)
+        
+        if self.recall_cache is not None:
+            self.recall_cache.put(user_id, query_embedding, top_k, version, result)
+        return result
+    
+    def _recall_uncached(self, user_id: str, query: str, top_k: int, query_embedding=None,
+                         filters: RecallFilter = None) -> str:
+        candidates = query_memories(user_id, query, top_k * RERANK_OVERFETCH, query_embedding, where=filters)
+        docs = candidates["documents"]
         
-        if not memories or len(memories) == 0:
+        if not docs:
             return ""
         
+        metas = candidates["metadatas"] or [{}] * len(docs)
+        importance = [memory_importance(doc, meta) for doc, meta in zip(docs, metas)]
+        order = rerank(candidates["distances"], ages_in_seconds(metas), importance, len(docs))
+        
         formatted = []
         seen = set()  
         
-        for mem in memories[:top_k]:
-            clean = mem.strip()
+        for i in order:
+            clean = docs[i].strip()
             if len(clean) > 10 and clean not in seen:
                 formatted.append(f"- {clean}")
                 seen.add(clean)
+            if len(formatted) == top_k:
+                break
         
         return "\n".join(formatted) if formatted else ""
     
     def clear_session(self, user_id: str):
         """Clear short-term buffer."""
         if user_id in self.short_term_buffer:
-            self.short_term_buffer[user_id] = []
\ No newline at end of file
+            self.short_term_buffer[user_id] = []
+    
+    def forget_user(self, user_id: str) -> int:
+        """Delete everything about a user: buffer, cached recalls and long-term memories."""
+        self.short_term_buffer.pop(user_id, None)
+        if self.recall_cache is not None:
+            self.recall_cache.forget(user_id)
+        return purge_user(user_id)
@@ -0,0 +1,198 @@
+import re
+from dataclasses import dataclass
+
+# anything in here is chit-chat, never worth a memory or a search
+SMALL_TALK = {
+    'hi', 'hello', 'hey', 'sup', 'yo', 'ok', 'okay', 'yes', 'no',
+    'thanks', 'bye', 'lol', 'haha', 'cool', 'nice', 'good',
+    'k', 'kk', 'ty', 'thx', 'lmao', 'hmm', 'yeah', 'yep', 'nah', 'wow', 'oh',
+}
+
+SAVE_KEYWORDS = [
+    'my name', 'i am', "i'm", 'my fav', 'i love', 'i like',
+    'i hate', 'i study', 'i work', 'i live', 'from', 'into',
+    'support', 'fan of'
+]
+
+SEARCH_PHRASES = [
+    'do you know about', 'tell me about', 'what do you know about',
+    'have you heard of', 'info about', 'information about',
+    'explain', 'who is', 'what is', 'when was', 'where is', 'how did'
+]
+
+
+# turn types that want a different reply shape (see generation_policy)
+EMOTIONAL_PHRASES = [
+    'i feel', "i'm feeling", 'feeling down', 'sad', 'depressed', 'anxious', 'anxiety',
+    'stressed', 'lonely', 'heartbroken', 'broke up', 'breakup', 'crying', 'cried',
+    'upset', 'overwhelmed', 'burnt out', 'miss her', 'miss him', 'hate myself', 'panic'
+]
+
+EXPLAIN_PHRASES = [
+    'explain', 'how does', 'how do', 'why does', 'why do', 'what is the difference',
+    'difference between', 'step by step', 'teach me', 'walk me through', 'in detail', 'how to'
+]
+
+
+def _alternation(phrases: list) -> str:
+    # longest first so "information about" wins over "info about" at the same spot
+    return "|".join(re.escape(p) for p in sorted(phrases, key=len, reverse=True))
+
+
+# one scan finds every keyword family; the lookahead lets matches overlap
+# (e.g. "i'm from" hits both "i'm" and "from") the same way the old substring checks did
+_SCANNER = re.compile(
+    f"(?=(?P<save>{_alternation(SAVE_KEYWORDS)})|(?P<search>{_alternation(SEARCH_PHRASES)}))"
+)
+
+_EMOTIONAL = re.compile(rf"\b(?:{_alternation(EMOTIONAL_PHRASES)})\b")
+_EXPLAIN = re.compile(rf"\b(?:{_alternation(EXPLAIN_PHRASES)})\b")
+
+_NON_WORD = re.compile(r"[^\w\s']+")
+
+_NAME_PATTERNS = [re.compile(p) for p in [
+    r"my name is (\w+)",
+    r"i'?m (\w+)",
+    r"call me (\w+)",
+    r"i am (\w+)"
+]]
+
+_ANIME_PATTERNS = [(re.compile(p), t) for p, t in [
+    (r"i love (?:watching |the anime )?([^,.!?]+?)(?:\s+anime|\s+show)?(?:\.|,|$)", "Loves anime: {0}"),
+    (r"i like (?:watching |the anime )?([^,.!?]+?)(?:\s+anime|\s+show)?(?:\.|,|$)", "Likes anime: {0}"),
+    (r"i'?m (?:really )?into (?:the anime )?([^,.!?]+?)(?:\s+anime)?(?:\.|,|$)", "Into anime: {0}"),
+    (r"my fav(?:orite)? anime is ([^,.!?]+)", "Favorite anime: {0}"),
+]]
+
+_SPORTS_PATTERNS = [(re.compile(p), t) for p, t in [
+    (r"my fav(?:orite)? (?:football |soccer )?(?:team|club) is ([^,.!?]+)", "Favorite club: {0}"),
+    (r"i support ([^,.!?]+?)(?:\s+(?:fc|football club))?(?:\.|,|$)", "Supports: {0}"),
+    (r"i'?m a(?: big)? ([^,.!?]+?) fan", "Fan of: {0}"),
+]]
+
+_GENERAL_PATTERNS = [(re.compile(p), t) for p, t in [
+    (r"my fav(?:orite)? (\w+) is ([^,.!?]+)", "Favorite {0}: {1}"),
+    (r"i love ([^,.!?]+?)(?:\.|,|$)", "Loves: {0}"),
+    (r"i like ([^,.!?]+?)(?:\.|,|$)", "Likes: {0}"),
+    (r"i hate ([^,.!?]+?)(?:\.|,|$)", "Dislikes: {0}"),
+]]
+
+_INFO_PATTERNS = [(re.compile(p), t) for p, t in [
+    (r"i (?:study|am studying) ([^,.!?]+)", "Studies: {0}"),
+    (r"i (?:work|am working) (?:as |at )?([^,.!?]+)", "Works: {0}"),
+    (r"i live in ([^,.!?]+)", "Lives in: {0}"),
+    (r"i'?m from ([^,.!?]+)", "From: {0}"),
+]]
+
+
+@dataclass
+class MessageAnalysis:
+    """Everything the turn pipeline wants to know about a message, computed once"""
+    text: str
+    lower: str
+    is_user: bool
+    word_count: int
+    is_trivial: bool
+    save_worthy: bool
+    search_intent: bool
+    fact: str = ""
+    # casual | search | emotional | explanation
+    turn_type: str = "casual"
+
+
+def extract_fact(message: str, message_lower: str) -> str:
+    """
+    Extract only the KEY information from a user message.
+    Falls back to the whole message when it's long enough to be worth keeping.
+    """
+    for pattern in _NAME_PATTERNS:
+        match = pattern.search(message_lower)
+        if match and len(match.group(1)) > 2:
+            name = match.group(1).title()
+            if name not in ['Into', 'From', 'Love', 'Like']:
+                return f"User's name: {name}"
+
+    for pattern, template in _ANIME_PATTERNS:
+        match = pattern.search(message_lower)
+        if match:
+            content = match.group(1).strip()
+
+            if len(content) > 2 and content not in ['it', 'that', 'this', 'anime']:
+                return template.format(content.title())
+
+    for pattern, template in _SPORTS_PATTERNS:
+        match = pattern.search(message_lower)
+        if match:
+            content = match.group(1).strip()
+            if len(content) > 2:
+                return template.format(content.title())
+
+    for pattern, template in _GENERAL_PATTERNS:
+        match = pattern.search(message_lower)
+        if match:
+            if "{0}" in template and "{1}" in template:
+                return template.format(match.group(1).strip(), match.group(2).strip().title())
+            else:
+                content = match.group(1).strip()
+                if len(content) > 2:
+                    return template.format(content.title())
+
+    for pattern, template in _INFO_PATTERNS:
+        match = pattern.search(message_lower)
+        if match:
+            return template.format(match.group(1).strip().title())
+
+    if len(message.split()) >= 5:
+        return message
+
+    return ""
+
+
+def analyze_message(message: str, is_user: bool = True) -> MessageAnalysis:
+    """Single pass over the message; every later step reads the result instead of rescanning"""
+    message_lower = message.lower().strip()
+    word_count = len(message.split())
+
+    bare = _NON_WORD.sub("", message_lower).strip()
+    is_trivial = not bare or bare in SMALL_TALK
+
+    has_save_keyword = False
+    search_intent = False
+    for match in _SCANNER.finditer(message_lower):
+        if match.lastgroup == "save":
+            has_save_keyword = True
+        else:
+            search_intent = True
+        if has_save_keyword and search_intent:
+            break
+
+    save_worthy = (
+        is_user
+        and len(message_lower) >= 5
+        and message_lower not in SMALL_TALK
+        and (has_save_keyword or word_count >= 5)
+    )
+
+    # emotional beats explanation beats search: a sad "how do i ..." still wants support first
+    if is_trivial:
+        turn_type = "casual"
+    elif _EMOTIONAL.search(message_lower):
+        turn_type = "emotional"
+    elif _EXPLAIN.search(message_lower):
+        turn_type = "explanation"
+    elif search_intent:
+        turn_type = "search"
+    else:
+        turn_type = "casual"
+
+    return MessageAnalysis(
+        text=message,
+        lower=message_lower,
+        is_user=is_user,
+        word_count=word_count,
+        is_trivial=is_trivial,
+        save_worthy=save_worthy,
+        search_intent=search_intent,
+        fact=extract_fact(message, message_lower) if save_worthy else "",
+        turn_type=turn_type,
+    )
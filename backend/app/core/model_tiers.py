@@ -0,0 +1,107 @@
+import os
+import json
+import threading
+import numpy as np
+from collections import deque, Counter
+from typing import Optional
+from app.core.message_analysis import MessageAnalysis
+
+MODEL_TIERING_ENABLED = os.getenv("MODEL_TIERING_ENABLED", "true").lower() == "true"
+# casual turns up to this many words go to the small model
+TIER_SMALL_MAX_WORDS = int(os.getenv("TIER_SMALL_MAX_WORDS", "12"))
+
+# small = low-latency model for chit-chat; large = None means the provider's *_MODEL
+# (claude has none: CLAUDE_MODEL already defaults to haiku, every turn stays on it unless MODEL_TIERS sets one)
+DEFAULT_MODEL_TIERS = {
+    "gemini": {"small": "gemini-2.0-flash-lite", "large": None},
+    "groq": {"small": "llama-3.1-8b-instant", "large": None},
+    "cohere": {"small": "command-r7b-12-2024", "large": None},
+}
+# e.g. MODEL_TIERS={"groq": {"small": "gemma2-9b-it", "large": "llama-3.3-70b-versatile"}}
+_overrides = json.loads(os.getenv("MODEL_TIERS", "{}"))
+MODEL_TIERS = {
+    provider: {**DEFAULT_MODEL_TIERS.get(provider, {}), **_overrides.get(provider, {})}
+    for provider in {*DEFAULT_MODEL_TIERS, *_overrides}
+}
+
+# USD per million input / output tokens, list prices at the time of writing - only used for the metrics
+DEFAULT_MODEL_PRICES = {
+    "llama-3.1-8b-instant": [0.05, 0.08],
+    "llama-3.3-70b-versatile": [0.59, 0.79],
+    "gemini-2.0-flash-lite": [0.075, 0.30],
+    "gemini-2.0-flash": [0.10, 0.40],
+    "gemini-2.0-flash-exp": [0.10, 0.40],
+    "claude-3-5-haiku-20241022": [0.80, 4.00],
+    "command-r7b-12-2024": [0.0375, 0.15],
+    "command-r-08-2024": [0.15, 0.60],
+}
+MODEL_PRICES = {**DEFAULT_MODEL_PRICES, **json.loads(os.getenv("MODEL_PRICES", "{}"))}
+
+
+def route(analysis: MessageAnalysis) -> str:
+    """small for short casual turns, large for searches, explanations, emotional and longer turns"""
+    if not MODEL_TIERING_ENABLED:
+        return "large"
+    if analysis.turn_type == "casual" and not analysis.search_intent and analysis.word_count <= TIER_SMALL_MAX_WORDS:
+        return "small"
+    return "large"
+
+
+def model_for(provider: str, tier: str) -> Optional[str]:
+    """Model name for a provider's tier, None = the provider's default model"""
+    return MODEL_TIERS.get(provider, {}).get(tier)
+
+
+def cost_usd(model: str, prompt_tokens: int, output_tokens: int) -> Optional[float]:
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + output_tokens * price[1]) / 1_000_000
+
+
+class TierStats:
+    """Latency, tokens and cost per tier, to check the small model is really buying speed"""
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._tiers = {}
+        self._lock = threading.Lock()
+
+    def record(self, tier: str, model: str, seconds: float, prompt_tokens: int, output_tokens: int):
+        cost = cost_usd(model, prompt_tokens, output_tokens)
+        with self._lock:
+            entry = self._tiers.setdefault(tier, {
+                "calls": 0, "prompt_tokens": 0, "output_tokens": 0, "cost_usd": 0.0, "unpriced_calls": 0,
+                "models": Counter(), "latencies": deque(maxlen=self.window)
+            })
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["output_tokens"] += output_tokens
+            entry["models"][model] += 1
+            entry["latencies"].append(seconds)
+            if cost is None:
+                entry["unpriced_calls"] += 1
+            else:
+                entry["cost_usd"] += cost
+
+    def stats(self) -> dict:
+        with self._lock:
+            report = {}
+            for tier, entry in self._tiers.items():
+                latencies = np.asarray(entry["latencies"])
+                report[tier] = {
+                    "calls": entry["calls"],
+                    "models": dict(entry["models"]),
+                    "p50_s": round(float(np.percentile(latencies, 50)), 3),
+                    "p95_s": round(float(np.percentile(latencies, 95)), 3),
+                    "avg_prompt_tokens": round(entry["prompt_tokens"] / entry["calls"], 1),
+                    "avg_output_tokens": round(entry["output_tokens"] / entry["calls"], 1),
+                    "cost_usd": round(entry["cost_usd"], 6),
+                    "cost_per_call_usd": round(entry["cost_usd"] / entry["calls"], 8),
+                    "unpriced_calls": entry["unpriced_calls"],
+                }
+            if "small" in report and "large" in report and report["small"]["p50_s"]:
+                report["p50_speedup"] = round(report["large"]["p50_s"] / report["small"]["p50_s"], 2)
+            return report
+
+
+tier_stats = TierStats()
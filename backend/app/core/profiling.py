@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+# profiling is off unless a token is configured; requests opt in with "X-Profile: <token>"
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+PROFILE_INTERVAL_S = float(os.getenv("PROFILE_INTERVAL_S", "0.005"))
+# always-on background sampler over every thread (0 = off), flushed to disk every PROFILE_FLUSH_S
+PROFILE_CONTINUOUS_HZ = float(os.getenv("PROFILE_CONTINUOUS_HZ", "0"))
+PROFILE_FLUSH_S = float(os.getenv("PROFILE_FLUSH_S", "300"))
+
+_labels = {}
+
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        # co_qualname is 3.11+; older interpreters only have the bare function name
+        name = getattr(code, "co_qualname", code.co_name)
+        label = _labels[code] = f"{name} ({os.path.basename(code.co_filename)})"
+    return label
+
+
+def _fold(frames: list) -> str:
+    """Outermost-first frames -> one collapsed-stack line key (flamegraph.pl / speedscope format)"""
+    return ";".join(_label(f.f_code) for f in frames)
+
+
+def _thread_stack(frame) -> list:
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _await_chain(task: asyncio.Task) -> tuple:
+    """Frames of a suspended task, outermost coroutine first, plus what it is waiting on"""
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return frames, type(awaitable).__name__ if awaitable is not None else None
+
+
+class RequestProfile:
+    """Samples of one request's task: its running stack, or the await chain it is parked on"""
+    def __init__(self, task: asyncio.Task, loop: asyncio.AbstractEventLoop, name: str):
+        self.task = task
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.name = name
+        self.samples = Counter()
+        self.started = time.perf_counter()
+        self.path = None
+
+    def sample(self, thread_frames: dict):
+        if asyncio.current_task(self.loop) is self.task:
+            stack = _thread_stack(thread_frames.get(self.loop_thread))
+            # drop the event loop's own frames, keep from the task's coroutine down
+            coro_frame = getattr(self.task.get_coro(), "cr_frame", None)
+            if coro_frame in stack:
+                stack = stack[stack.index(coro_frame):]
+            self.samples[_fold(stack)] += 1
+        else:
+            frames, waiting_on = _await_chain(self.task)
+            if frames:
+                leaf = f";[await {waiting_on}]" if waiting_on else ""
+                self.samples[_fold(frames) + leaf] += 1
+            # work handed to asyncio.to_thread shows up under the worker threads
+            # (with concurrent requests, theirs are included too)
+            for ident, frame in thread_frames.items():
+                if ident == self.loop_thread:
+                    continue
+                stack = _thread_stack(frame)
+                if any("/app/" in f.f_code.co_filename for f in stack):
+                    self.samples["[thread];" + _fold(stack)] += 1
+
+
+class Profiler:
+    """
+    One daemon thread that samples stacks only while someone is listening:
+    per-request profiles at PROFILE_INTERVAL_S, and the continuous sampler at PROFILE_CONTINUOUS_HZ.
+    With neither active it blocks on an Event, so there is nothing to pay when profiling is off.
+    """
+    def __init__(self, out_dir: str = PROFILE_DIR, interval_s: float = PROFILE_INTERVAL_S,
+                 continuous_hz: float = PROFILE_CONTINUOUS_HZ):
+        self.out_dir = out_dir
+        self.interval_s = interval_s
+        self.continuous_interval_s = 1.0 / continuous_hz if continuous_hz > 0 else None
+        self.active = set()
+        self.continuous = Counter()
+        self.last_flush = time.monotonic()
+        self.fraction = 0.0
+        self.fraction_until = 0.0
+        self.written = 0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+            self._thread.start()
+        if self.continuous_interval_s:
+            self._wake.set()
+
+    def wants(self, header: Optional[str]) -> bool:
+        """Should this request be profiled: right token in the header, or picked by the admin sampling fraction"""
+        if not PROFILE_TOKEN:
+            return False
+        if header == PROFILE_TOKEN:
+            return True
+        return self.fraction > 0 and time.monotonic() < self.fraction_until and random.random() < self.fraction
+
+    def sample_fraction(self, fraction: float, duration_s: float):
+        self.fraction = max(0.0, min(1.0, fraction))
+        self.fraction_until = time.monotonic() + duration_s
+
+    @contextmanager
+    def profile_request(self, name: str):
+        """Profile the calling task for the duration of the block; the folded file path is on .path afterwards"""
+        profile = RequestProfile(asyncio.current_task(), asyncio.get_running_loop(), name)
+        self.start()
+        with self._lock:
+            self.active.add(profile)
+        self._wake.set()
+        try:
+            yield profile
+        finally:
+            with self._lock:
+                self.active.discard(profile)
+            elapsed_ms = (time.perf_counter() - profile.started) * 1000
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)[:40]
+            profile.path = self._write(f"request-{stamp}-{safe_name}-{elapsed_ms:.0f}ms.folded", profile.samples)
+
+    def _write(self, filename: str, samples: Counter) -> Optional[str]:
+        if not samples:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, filename)
+        with open(path, "w") as f:
+            f.write("".join(f"{stack} {count}\n" for stack, count in samples.most_common()))
+        self.written += 1
+        return path
+
+    def _run(self):
+        me = threading.get_ident()
+        next_continuous = time.monotonic()
+        while True:
+            with self._lock:
+                requests = list(self.active)
+            if not requests and not self.continuous_interval_s:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            now = time.monotonic()
+            frames = sys._current_frames()
+            frames.pop(me, None)
+            for profile in requests:
+                try:
+                    profile.sample(frames)
+                except Exception:
+                    pass  # a racing frame is not worth breaking the sampler for
+
+            if self.continuous_interval_s and now >= next_continuous:
+                next_continuous = now + self.continuous_interval_s
+                for frame in frames.values():
+                    try:
+                        self.continuous[_fold(_thread_stack(frame))] += 1
+                    except Exception:
+                        pass
+                if now - self.last_flush >= PROFILE_FLUSH_S:
+                    self.flush_continuous()
+            del frames
+
+            time.sleep(self.interval_s if requests else self.continuous_interval_s)
+
+    def flush_continuous(self):
+        samples, self.continuous = self.continuous, Counter()
+        self.last_flush = time.monotonic()
+        self._write(f"continuous-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded", samples)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": bool(PROFILE_TOKEN),
+            "continuous_hz": round(1.0 / self.continuous_interval_s, 2) if self.continuous_interval_s else 0,
+            "sampling_fraction": self.fraction if time.monotonic() < self.fraction_until else 0.0,
+            "active_profiles": len(self.active),
+            "files_written": self.written,
+            "dir": self.out_dir,
+        }
+
+
+profiler = Profiler()
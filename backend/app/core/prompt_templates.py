@@ -1,3 +1,6 @@
+from app.core.message_analysis import MessageAnalysis, analyze_message
+
+
 def build_prompt(user_id: str, recent_messages: str, retrieved_memories: str, user_message: str) -> str:
     """
     More natural Gen-Z voice with better memory integration.
@@ -61,30 +64,10 @@ STAN:"""
     return prompt
 
 
-def should_save_to_memory(message: str, is_user: bool) -> bool:
+def should_save_to_memory(message: str, is_user: bool, analysis: MessageAnalysis = None) -> bool:
     """Save only important facts"""
     if not is_user:
         return False
     
-    message_lower = message.lower().strip()
-    
-    if len(message_lower) < 5:
-        return False
-    
-    skip = {'hi', 'hello', 'hey', 'sup', 'yo', 'ok', 'okay', 'yes', 'no', 
-            'thanks', 'bye', 'lol', 'haha', 'cool', 'nice', 'good'}
-    
-    if message_lower in skip:
-        return False
-    
-    important = ['my name', 'i am', "i'm", 'my fav', 'i love', 'i like', 
-                 'i hate', 'i study', 'i work', 'i live', 'from', 'into',
-                 'support', 'fan of']
-    
-    if any(word in message_lower for word in important):
-        return True
-    
-    if len(message.split()) >= 5:
-        return True
-    
-    return False
\ No newline at end of file
+    analysis = analysis or analyze_message(message, is_user)
+    return analysis.save_worthy
@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+QUOTA_DB_PATH = os.getenv("QUOTA_DB_PATH", "./quota_ledger.sqlite3")
+
+# keep a couple of days of buckets around for /stats, older rows get pruned
+_KEEP_DAY_BUCKETS = 3
+
+
+class QuotaExceeded(Exception):
+    """Raised when a provider budget has no room left for a request"""
+    def __init__(self, provider: str, window: str, retry_after: float):
+        super().__init__(f"{provider} {window} quota exhausted, retry in {retry_after:.1f}s")
+        self.provider = provider
+        self.window = window
+        self.retry_after = retry_after
+
+
+class QuotaLedger:
+    """
+    Shared per-provider request/token counters stored in sqlite.
+    Every worker process points at the same file, so the rpm/rpd/tpm budgets
+    in PROVIDER_LIMITS hold across workers and survive restarts.
+    Updates run inside BEGIN IMMEDIATE so check-and-increment is atomic.
+    """
+    def __init__(self, path: str = QUOTA_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._init_db()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                provider TEXT NOT NULL,
+                window   TEXT NOT NULL,
+                bucket   TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                tokens   INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (provider, window, bucket)
+            )
+        """)
+
+    @staticmethod
+    def _buckets(now: float):
+        minute = str(int(now // 60))
+        day = datetime.fromtimestamp(now, tz=timezone.utc).strftime("%Y-%m-%d")
+        return minute, day
+
+    @staticmethod
+    def _read(conn, provider: str, window: str, bucket: str):
+        row = conn.execute(
+            "SELECT requests, tokens FROM usage WHERE provider=? AND window=? AND bucket=?",
+            (provider, window, bucket)
+        ).fetchone()
+        return row if row else (0, 0)
+
+    @staticmethod
+    def _bump(conn, provider: str, window: str, bucket: str, requests: int, tokens: int):
+        conn.execute("""
+            INSERT INTO usage (provider, window, bucket, requests, tokens)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(provider, window, bucket) DO UPDATE SET
+                requests = MAX(0, requests + excluded.requests),
+                tokens   = MAX(0, tokens + excluded.tokens)
+        """, (provider, window, bucket, requests, tokens))
+
+    def try_reserve(self, provider: str, limits: dict, tokens: int = 0, now: Optional[float] = None) -> dict:
+        """
+        Reserve one request (+ estimated tokens) if the minute and day budgets allow it.
+        Raises QuotaExceeded with a retry_after hint otherwise.
+        """
+        now = time.time() if now is None else now
+        minute, day = self._buckets(now)
+        rpm = limits.get("rpm", 10)
+        rpd = limits.get("rpd", 1000)
+        tpm = limits.get("tpm")
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            day_req, day_tok = self._read(conn, provider, "day", day)
+            min_req, min_tok = self._read(conn, provider, "minute", minute)
+
+            if day_req >= rpd:
+                tomorrow = (int(now // 86400) + 1) * 86400
+                raise QuotaExceeded(provider, "day", tomorrow - now)
+
+            over_tokens = tpm is not None and min_req > 0 and min_tok + tokens > tpm
+            if min_req >= rpm or over_tokens:
+                next_minute = (int(now // 60) + 1) * 60
+                raise QuotaExceeded(provider, "minute", next_minute - now)
+
+            self._bump(conn, provider, "minute", minute, 1, tokens)
+            self._bump(conn, provider, "day", day, 1, tokens)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return {
+            "daily_used": day_req + 1,
+            "daily_remaining": rpd - day_req - 1,
+            "minute_remaining": rpm - min_req - 1,
+            "minute_tokens": min_tok + tokens,
+            "minute_bucket": minute,
+            "day_bucket": day,
+        }
+
+    def adjust(self, provider: str, reservation: dict, requests: int = 0, tokens: int = 0):
+        """Correct a reservation after the fact (actual token usage, or give a request back)"""
+        if not requests and not tokens:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._bump(conn, provider, "minute", reservation["minute_bucket"], requests, tokens)
+            self._bump(conn, provider, "day", reservation["day_bucket"], requests, tokens)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def mark_minute_full(self, provider: str, rpm: int, now: Optional[float] = None):
+        """Provider answered 429 - make every worker sit out the rest of this minute"""
+        now = time.time() if now is None else now
+        minute, _ = self._buckets(now)
+        conn = self._conn()
+        conn.execute("""
+            INSERT INTO usage (provider, window, bucket, requests, tokens)
+            VALUES (?, 'minute', ?, ?, 0)
+            ON CONFLICT(provider, window, bucket) DO UPDATE SET
+                requests = MAX(requests, excluded.requests)
+        """, (provider, minute, rpm))
+
+    def snapshot(self, provider: str, now: Optional[float] = None) -> dict:
+        now = time.time() if now is None else now
+        minute, day = self._buckets(now)
+        conn = self._conn()
+        min_req, min_tok = self._read(conn, provider, "minute", minute)
+        day_req, day_tok = self._read(conn, provider, "day", day)
+        return {
+            "minute_requests": min_req,
+            "minute_tokens": min_tok,
+            "day_requests": day_req,
+            "day_tokens": day_tok,
+        }
+
+    def prune(self, now: Optional[float] = None):
+        """Drop buckets nobody will read again"""
+        now = time.time() if now is None else now
+        oldest_minute = int(now // 60) - 5
+        oldest_day = datetime.fromtimestamp(
+            now - _KEEP_DAY_BUCKETS * 86400, tz=timezone.utc
+        ).strftime("%Y-%m-%d")
+        conn = self._conn()
+        # minute buckets are epoch-minute numbers, compare them as integers
+        conn.execute(
+            "DELETE FROM usage WHERE window='minute' AND CAST(bucket AS INTEGER) < ?",
+            (oldest_minute,)
+        )
+        conn.execute("DELETE FROM usage WHERE window='day' AND bucket < ?", (oldest_day,))
@@ -0,0 +1,91 @@
+import os
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+
+RECALL_CACHE_ENABLED = os.getenv("RECALL_CACHE_ENABLED", "true").lower() == "true"
+RECALL_CACHE_MAX_USERS = int(os.getenv("RECALL_CACHE_MAX_USERS", "2000"))
+RECALL_CACHE_PER_USER = int(os.getenv("RECALL_CACHE_PER_USER", "4"))
+RECALL_CACHE_TTL_S = float(os.getenv("RECALL_CACHE_TTL_S", "300"))
+# how close (cosine) a new query must be to a cached one to reuse its result
+RECALL_CACHE_THRESHOLD = float(os.getenv("RECALL_CACHE_THRESHOLD", "0.95"))
+
+
+class RecallCache:
+    """
+    Recent recall_context results per user, reused for near-identical follow-up queries.
+    An entry is only valid while the user's memory version (bumped on every write) is unchanged,
+    and for at most ttl_s - versions are per process, the TTL bounds staleness across workers.
+    Bounded to max_users users x per_user entries, least recently used users go first.
+    """
+    def __init__(self, max_users: int = RECALL_CACHE_MAX_USERS, per_user: int = RECALL_CACHE_PER_USER,
+                 ttl_s: float = RECALL_CACHE_TTL_S, threshold: float = RECALL_CACHE_THRESHOLD):
+        self.max_users = max_users
+        self.per_user = per_user
+        self.ttl_s = ttl_s
+        self.threshold = threshold
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        v = np.array(vector, dtype=np.float32)
+        return v / max(float(np.linalg.norm(v)), 1e-12)
+
+    def get(self, user_id: str, query_embedding, top_k: int, version: int) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries:
+                # anything written since (or expired) is useless now
+                fresh = [e for e in entries if e["version"] == version and e["expires"] > now]
+                self.invalidated += len(entries) - len(fresh)
+                entries[:] = fresh
+
+            if entries:
+                self._users.move_to_end(user_id)
+                query = self._unit(query_embedding)
+                for entry in entries:
+                    if entry["top_k"] == top_k and float(entry["query"] @ query) >= self.threshold:
+                        self.hits += 1
+                        return entry["result"]
+
+            self.misses += 1
+            return None
+
+    def put(self, user_id: str, query_embedding, top_k: int, version: int, result: str):
+        entry = {
+            "query": self._unit(query_embedding),
+            "top_k": top_k,
+            "version": version,
+            "result": result,
+            "expires": time.monotonic() + self.ttl_s,
+        }
+        with self._lock:
+            entries = self._users.setdefault(user_id, [])
+            self._users.move_to_end(user_id)
+            entries.append(entry)
+            if len(entries) > self.per_user:
+                entries.pop(0)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def forget(self, user_id: str):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "invalidated": self.invalidated,
+            "users": len(self._users),
+            "entries": sum(len(e) for e in self._users.values()),
+        }
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+from datetime import datetime
+
+RERANK_OVERFETCH = int(os.getenv("RERANK_OVERFETCH", "3"))
+
+# score = w_sim * similarity + w_recency * recency + w_importance * importance
+RERANK_WEIGHTS = {
+    "similarity": float(os.getenv("RERANK_W_SIMILARITY", "1.0")),
+    "recency": float(os.getenv("RERANK_W_RECENCY", "0.25")),
+    "importance": float(os.getenv("RERANK_W_IMPORTANCE", "0.35")),
+}
+RERANK_HALF_LIFE_DAYS = float(os.getenv("RERANK_HALF_LIFE_DAYS", "14"))
+
+# how much a memory is worth by what kind of thing it is
+IMPORTANCE = {
+    "name": 1.0,
+    "fact": 0.8,
+    "message": 0.4,
+    "assistant": 0.2,
+}
+
+
+def ages_in_seconds(metadatas: list, now: datetime = None) -> np.ndarray:
+    """Age of each memory from its ISO timestamp (unknown = very old)"""
+    now = now or datetime.now()
+    ages = np.full(len(metadatas), 10 * 365 * 86400.0)
+    for i, meta in enumerate(metadatas):
+        stamp = (meta or {}).get("timestamp")
+        if stamp:
+            try:
+                ages[i] = (now - datetime.fromisoformat(stamp)).total_seconds()
+            except ValueError:
+                pass
+    return ages
+
+
+def rerank(distances, ages, importance, top_k: int, weights: dict = None,
+           half_life_days: float = RERANK_HALF_LIFE_DAYS) -> np.ndarray:
+    """
+    Score all candidates in one vectorized pass and return the indices of the best top_k.
+    Distances are chroma's default squared L2 over unit-length MiniLM vectors,
+    so cosine similarity = 1 - d/2.
+    """
+    weights = weights or RERANK_WEIGHTS
+    distances = np.asarray(distances, dtype=np.float64)
+    if distances.size == 0:
+        return np.empty(0, dtype=np.int64)
+
+    similarity = np.clip(1.0 - distances / 2.0, 0.0, 1.0)
+    recency = np.exp2(-np.maximum(np.asarray(ages, dtype=np.float64), 0.0) / (half_life_days * 86400.0))
+    scores = (
+        weights["similarity"] * similarity
+        + weights["recency"] * recency
+        + weights["importance"] * np.asarray(importance, dtype=np.float64)
+    )
+
+    if top_k >= scores.size:
+        return np.argsort(-scores, kind="stable")
+    best = np.argpartition(-scores, top_k)[:top_k]
+    return best[np.argsort(-scores[best], kind="stable")]
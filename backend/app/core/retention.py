@@ -0,0 +1,142 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import numpy as np
+from datetime import datetime
+from app.db.vector_store import (
+    CHROMA_PATH, NUMPY_STORE_PATH, list_user_ids, get_all_memories, delete_memories, compact_user,
+    update_memory_metadata
+)
+from app.db.memory_filters import timestamp_of
+from app.db.maintenance import dir_size, remove_orphan_segments, vacuum_sqlite
+from app.core.quota_ledger import QUOTA_DB_PATH, QuotaLedger
+from app.core.logging_setup import configure_logging
+from app.core.reranker import ages_in_seconds
+from app.core.memory_manager import memory_importance, fact_type_of
+from app.core.memory_consolidation import CONSOLIDATION_STATE_PATH, CONSOLIDATION_PAUSE_S, _single_worker_lock
+
+# 0 = no limit
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_PER_USER = int(os.getenv("RETENTION_MAX_PER_USER", "0"))
+# 0 = only run maintenance from the command line / cron
+MAINTENANCE_INTERVAL_S = float(os.getenv("MAINTENANCE_INTERVAL_S", "0"))
+
+log = logging.getLogger(__name__)
+
+
+def expired_ids(data: dict, max_age_days: float = RETENTION_MAX_AGE_DAYS,
+                max_per_user: int = RETENTION_MAX_PER_USER, now: datetime = None) -> list:
+    """
+    Ids a user's memories lose under the retention policy: everything older than max_age_days,
+    then the least important / oldest ones beyond max_per_user (a name outlives chit-chat).
+    """
+    ids = data.get("ids") or []
+    if not ids:
+        return []
+    docs = data["documents"]
+    metas = [m or {} for m in data["metadatas"]]
+    ages = ages_in_seconds(metas, now)
+
+    keep = np.ones(len(ids), dtype=bool)
+    if max_age_days > 0:
+        keep &= ages <= max_age_days * 86400
+    if max_per_user > 0 and keep.sum() > max_per_user:
+        importance = np.array([memory_importance(d, m) for d, m in zip(docs, metas)])
+        candidates = np.flatnonzero(keep)
+        # most important first, newest first among equals
+        ranked = candidates[np.lexsort((ages[candidates], -importance[candidates]))]
+        keep[ranked[max_per_user:]] = False
+    return [ids[i] for i in np.flatnonzero(~keep)]
+
+
+def apply_retention(user_id: str, max_age_days: float = RETENTION_MAX_AGE_DAYS,
+                    max_per_user: int = RETENTION_MAX_PER_USER) -> int:
+    if max_age_days <= 0 and max_per_user <= 0:
+        return 0
+    removed = expired_ids(get_all_memories(user_id), max_age_days, max_per_user)
+    delete_memories(user_id, removed)
+    return len(removed)
+
+
+def tag_filter_fields(user_id: str) -> int:
+    """Give memories written before filtered recall existed their "ts" and "fact_type" fields"""
+    data = get_all_memories(user_id)
+    ids, metas = [], []
+    for doc_id, doc, meta in zip(data["ids"], data["documents"], data["metadatas"]):
+        meta = dict(meta or {})
+        if "ts" in meta and "fact_type" in meta:
+            continue
+        ts = timestamp_of(meta)
+        if ts is not None:
+            meta["ts"] = ts
+        meta["fact_type"] = fact_type_of(doc, meta.get("role", "user"))
+        ids.append(doc_id)
+        metas.append(meta)
+    if ids:
+        update_memory_metadata(user_id, ids, metas)
+    return len(ids)
+
+
+def run_maintenance(full_vacuum: bool = False, pause_s: float = CONSOLIDATION_PAUSE_S) -> dict:
+    """
+    Apply retention to every user, compact numpy files, drop orphaned HNSW segments
+    and vacuum the sqlite files. Works user by user with pauses so chat traffic
+    keeps going; only the VACUUM itself locks a database, and only when it's worth it.
+    """
+    started = time.perf_counter()
+    before = dir_size(CHROMA_PATH) + dir_size(NUMPY_STORE_PATH) + dir_size(QUOTA_DB_PATH)
+    report = {"users": 0, "memories_expired": 0, "memories_tagged": 0, "compacted_bytes": 0,
+              "orphan_segment_bytes": 0, "vacuumed_bytes": 0}
+
+    for user_id in list_user_ids():
+        try:
+            report["memories_expired"] += apply_retention(user_id)
+            report["memories_tagged"] += tag_filter_fields(user_id)
+            report["compacted_bytes"] += compact_user(user_id)
+        except Exception as e:
+            log.exception(f"Maintenance failed for {user_id}: {e}")
+        report["users"] += 1
+        time.sleep(pause_s)
+
+    report["orphan_segment_bytes"] = remove_orphan_segments(CHROMA_PATH)
+    QuotaLedger(QUOTA_DB_PATH).prune()
+    report["vacuumed_bytes"] = (
+        vacuum_sqlite(os.path.join(CHROMA_PATH, "chroma.sqlite3"), force=full_vacuum)
+        + vacuum_sqlite(QUOTA_DB_PATH, force=full_vacuum)
+    )
+
+    after = dir_size(CHROMA_PATH) + dir_size(NUMPY_STORE_PATH) + dir_size(QUOTA_DB_PATH)
+    report["bytes_reclaimed"] = max(0, before - after)
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    log.info(f"🧽 Maintenance: {report['memories_expired']} memories expired, "
+             f"{report['bytes_reclaimed'] / 2**20:.1f} MB reclaimed in {report['seconds']}s", extra=report)
+    return report
+
+
+def run_locked_maintenance(full_vacuum: bool = False) -> dict:
+    # same lock as consolidation: the two never rewrite a user's memories at the same time
+    with _single_worker_lock(f"{CONSOLIDATION_STATE_PATH}.lock") as acquired:
+        if not acquired:
+            return {"skipped": "another worker is running consolidation or maintenance"}
+        return run_maintenance(full_vacuum)
+
+
+async def maintenance_loop(interval_s: float = MAINTENANCE_INTERVAL_S):
+    """Background task: run maintenance every interval_s in a worker thread"""
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            await asyncio.to_thread(run_locked_maintenance)
+        except Exception as e:
+            log.exception(f"Maintenance pass failed: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply memory retention and reclaim disk space")
+    parser.add_argument("--full-vacuum", action="store_true",
+                        help="VACUUM the sqlite files even if few pages are free (briefly blocks writes)")
+    args = parser.parse_args()
+    configure_logging()
+    print(run_locked_maintenance(args.full_vacuum))
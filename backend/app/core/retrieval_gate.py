@@ -0,0 +1,134 @@
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Optional
+from app.core.message_analysis import MessageAnalysis
+from app.db.memory_filters import RecallFilter
+
+RECALL_GATING_ENABLED = os.getenv("RECALL_GATING_ENABLED", "true").lower() == "true"
+# what every turn used to get
+RECALL_TOP_K = int(os.getenv("RECALL_TOP_K", "6"))
+# general-knowledge turns only need a little personal colour
+RECALL_TOPIC_TOP_K = int(os.getenv("RECALL_TOPIC_TOP_K", "2"))
+
+# the user talking about themselves, or about what was said before - always worth a lookup
+# ("tell me about X" is a topic question, not one about the user)
+_ABOUT_USER = re.compile(
+    r"\b(?:i|i'm|im|i've|i'd|i'll|(?<!tell )(?<!show )(?<!give )(?<!teach )me|my|mine|myself|we|us|our|"
+    r"remember|recall|forgot|told you|said|last time|earlier|before|again)\b"
+)
+# "yeah", "sure thing", "not really" after STAN asked something - the buffer already has the context
+SHORT_ANSWER_WORDS = 3
+
+# asking about what was said before ("what did I tell you yesterday") - only then does a time phrase scope recall
+_RECALLING = re.compile(r"\b(?:did i|have i|i told|told you|i said|i mentioned|we talked|we discussed|did we|remember|recall)\b")
+_TIME_PHRASE = re.compile(
+    r"\b(earlier today|this morning|today|tonight|last night|yesterday|this week|last week|"
+    r"this month|last month|(\d+) days? ago)\b"
+)
+# a real question: ends in "?" or opens with a wh-word ("did you know my favorite..." is a statement)
+_QUESTION = re.compile(r"\?\s*$|^(?:what|who|where|which|when|how)\b")
+# questions about one kind of fact -> the fact_type tags written with each memory
+_FACT_QUESTIONS = [
+    (re.compile(r"\bmy name\b|\bwho am i\b"), ("name",)),
+    (re.compile(r"\bwhere (?:do|did) i live\b|\bwhere am i from\b|\bwhere i(?:'m| am)? (?:from|live)\b"), ("location",)),
+    (re.compile(r"\bmy fav(?:ou?rite)?\b"), ("favorite",)),
+    (re.compile(r"\bwhat do i (?:study|work)\b|\bwhere do i (?:study|work)\b"), ("studies", "work")),
+]
+
+
+def _time_range(phrase: str, days: Optional[str], now: datetime) -> tuple:
+    """[since, until) in epoch seconds for a time phrase, until None = up to now"""
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if phrase in ("earlier today", "this morning", "today", "tonight"):
+        return midnight.timestamp(), None
+    if phrase in ("yesterday", "last night"):
+        return (midnight - timedelta(days=1)).timestamp(), midnight.timestamp()
+    if days is not None:
+        day = midnight - timedelta(days=int(days))
+        return day.timestamp(), (day + timedelta(days=1)).timestamp()
+    monday = midnight - timedelta(days=midnight.weekday())
+    if phrase == "this week":
+        return monday.timestamp(), None
+    if phrase == "last week":
+        return (monday - timedelta(days=7)).timestamp(), monday.timestamp()
+    first = midnight.replace(day=1)
+    if phrase == "this month":
+        return first.timestamp(), None
+    previous = (first - timedelta(days=1)).replace(day=1)
+    return previous.timestamp(), first.timestamp()
+
+
+class RecallGate:
+    """
+    Decides per turn whether long-term recall runs and with how many results,
+    from the message analysis and STAN's previous line. A few regex checks, no I/O.
+    """
+    def __init__(self):
+        self.turns = 0
+        self.reasons = Counter()
+        self.top_k = Counter()
+        self.results_saved = 0
+        self.gate_ns = 0
+        self.scoped = Counter()
+
+    def plan(self, analysis: MessageAnalysis, last_reply: str = "") -> int:
+        """top_k to recall for this turn, 0 = skip it"""
+        started = time.perf_counter_ns()
+        top_k, reason = self._decide(analysis, last_reply)
+        self.gate_ns += time.perf_counter_ns() - started
+        self.turns += 1
+        self.reasons[reason] += 1
+        self.top_k[top_k] += 1
+        self.results_saved += RECALL_TOP_K - top_k
+        return top_k
+
+    def _decide(self, analysis: MessageAnalysis, last_reply: str) -> tuple:
+        if not RECALL_GATING_ENABLED:
+            return RECALL_TOP_K, "gating_off"
+        if analysis.is_trivial:
+            return 0, "small_talk"
+        if _ABOUT_USER.search(analysis.lower):
+            return RECALL_TOP_K, "about_user"
+        if analysis.word_count <= SHORT_ANSWER_WORDS and last_reply.rstrip().endswith("?"):
+            return 0, "answer_to_question"
+        if analysis.turn_type in ("search", "explanation"):
+            return RECALL_TOPIC_TOP_K, "topic"
+        return RECALL_TOP_K, "default"
+
+    def scope(self, analysis: MessageAnalysis, now: datetime = None) -> Optional[RecallFilter]:
+        """Filter for questions about a time span or a kind of fact, None for plain recall"""
+        if not RECALL_GATING_ENABLED:
+            return None
+        text = analysis.lower
+        if _RECALLING.search(text):
+            match = _TIME_PHRASE.search(text)
+            if match:
+                since, until = _time_range(match.group(1), match.group(2), now or datetime.now())
+                self.scoped["time"] += 1
+                return RecallFilter(role="user", since=since, until=until)
+        if _QUESTION.search(text):
+            for pattern, fact_types in _FACT_QUESTIONS:
+                if pattern.search(text):
+                    self.scoped["fact_type"] += 1
+                    return RecallFilter(fact_types=fact_types)
+        return None
+
+    def stats(self) -> dict:
+        skipped = self.top_k.get(0, 0)
+        return {
+            "enabled": RECALL_GATING_ENABLED,
+            "turns": self.turns,
+            "recalls_skipped": skipped,
+            "skip_rate": round(skipped / self.turns, 3) if self.turns else 0.0,
+            "results_saved": self.results_saved,
+            "by_reason": dict(self.reasons),
+            "by_top_k": {str(k): n for k, n in sorted(self.top_k.items())},
+            "filtered_recalls": dict(self.scoped),
+            "avg_gate_us": round(self.gate_ns / self.turns / 1000, 2) if self.turns else 0.0,
+        }
+
+
+recall_gate = RecallGate()
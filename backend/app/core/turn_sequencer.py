@@ -0,0 +1,124 @@
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+# 0 = no coalescing, every message is its own turn (still one at a time per user)
+TURN_COALESCE_WINDOW_MS = float(os.getenv("TURN_COALESCE_WINDOW_MS", "0"))
+# most messages merged into one turn
+TURN_COALESCE_MAX = int(os.getenv("TURN_COALESCE_MAX", "4"))
+
+
+class _Burst:
+    """Messages that will be answered by one turn"""
+    def __init__(self, group: Optional[str]):
+        self.group = group
+        self.messages = []
+        self.contexts = []
+        self.closed = False
+        self.waiters = 0
+        self.task = None
+
+
+class _UserQueue:
+    def __init__(self):
+        self.lock = asyncio.Lock()  # FIFO, so turns run in arrival order
+        self.open = None
+        self.pending = 0
+
+
+class TurnSequencer:
+    """
+    One turn at a time per user, different users in parallel.
+    With a coalescing window, messages that arrive within it (or while the user's
+    previous turn is still running) are merged into a single turn and a single provider call;
+    every request in the burst gets that turn's reply.
+    Only requests with the same group (the API key they are billed to) share a burst.
+    """
+    def __init__(self, window_ms: float = TURN_COALESCE_WINDOW_MS, max_messages: int = TURN_COALESCE_MAX):
+        self.window_s = window_ms / 1000.0
+        self.max_messages = max_messages
+        self.users = {}
+        self.turns = 0
+        self.messages = 0
+        self.merged = 0
+        self.max_depth = 0
+        self.wait_s = 0.0
+
+    async def submit(self, user_id: str, message: str, run: Callable[[str, list], Awaitable],
+                     coalesce: bool = True, group: Optional[str] = None, context: Any = None) -> tuple:
+        """
+        Queue message behind the user's earlier turns; run(text, contexts) does the turn,
+        contexts being what every request in the burst passed as context, in arrival order.
+        Returns (result, messages in the burst, this message's position in it).
+        """
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = _UserQueue()
+
+        burst = user.open
+        can_join = (coalesce and self.window_s > 0 and burst is not None and not burst.closed
+                    and len(burst.messages) < self.max_messages and burst.group == group)
+        if not can_join:
+            burst = _Burst(group)
+            if coalesce and self.window_s > 0:
+                user.open = burst
+            user.pending += 1
+            self.max_depth = max(self.max_depth, user.pending)
+            burst.task = asyncio.ensure_future(self._run(user, burst, run))
+            # a callback, not a finally: a task cancelled before it started never runs its body
+            burst.task.add_done_callback(lambda _: self._finish(user_id, user, burst))
+        else:
+            self.merged += 1
+        burst.messages.append(message)
+        burst.contexts.append(context)
+        position = len(burst.messages) - 1
+        self.messages += 1
+
+        # the turn belongs to the whole burst; it only stops when every requester gave up on it
+        burst.waiters += 1
+        try:
+            result = await asyncio.shield(burst.task)
+        except asyncio.CancelledError:
+            burst.waiters -= 1
+            if burst.waiters == 0:
+                burst.task.cancel()
+            raise
+        burst.waiters -= 1
+        return result, len(burst.messages), position
+
+    async def _run(self, user: _UserQueue, burst: _Burst, run: Callable[[str, list], Awaitable]):
+        if user.open is burst:
+            await asyncio.sleep(self.window_s)
+        queued = time.monotonic()
+        async with user.lock:
+            # anything arriving from now on goes into the next turn
+            burst.closed = True
+            if user.open is burst:
+                user.open = None
+            self.wait_s += time.monotonic() - queued
+            self.turns += 1
+            return await run("\n".join(burst.messages), burst.contexts)
+
+    def _finish(self, user_id: str, user: _UserQueue, burst: _Burst):
+        burst.closed = True
+        if user.open is burst:
+            user.open = None
+        user.pending -= 1
+        if user.pending == 0 and self.users.get(user_id) is user:
+            del self.users[user_id]
+
+    def stats(self) -> dict:
+        return {
+            "coalesce_window_ms": self.window_s * 1000,
+            "active_users": len(self.users),
+            "queued_turns": sum(u.pending for u in self.users.values()),
+            "max_depth": self.max_depth,
+            "messages": self.messages,
+            "turns": self.turns,
+            "messages_merged": self.merged,
+            "avg_wait_ms": round(self.wait_s / self.turns * 1000, 1) if self.turns else 0.0,
+        }
+
+
+turn_sequencer = TurnSequencer()
@@ -0,0 +1,228 @@
+import os
+import time
+import fcntl
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+from chromadb.api.types import EmbeddingFunction
+from app.db.embeddings import EMBEDDING_MODEL, EMBEDDING_DIM, EMBEDDING_BACKEND, embedding_space
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "true").lower() == "true"
+EMBED_CACHE_MEMORY_ITEMS = int(os.getenv("EMBED_CACHE_MEMORY_ITEMS", "20000"))
+# slots in the shared on-disk table (~1.5KB each, the file is sparse until filled); 0 = memory only
+EMBED_CACHE_DISK_ITEMS = int(os.getenv("EMBED_CACHE_DISK_ITEMS", "50000"))
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "./embedding_cache")
+
+_EMPTY = bytes(16)
+
+
+def normalize(text: str) -> str:
+    # MiniLM's tokenizer lowercases and splits on whitespace anyway,
+    # so these variants embed to the exact same vector
+    return " ".join(unicodedata.normalize("NFC", text).lower().split())
+
+
+class DiskEmbeddingStore:
+    """
+    Fixed-size open-addressing table in one memory-mapped file, shared by every worker.
+    Slot = 16-byte key + float32 vector. Writers serialise on flock; readers take no lock and
+    re-check the key after copying the vector, so a slot rewritten underneath them is a miss.
+    Full probe windows overwrite their home slot - it's a cache, losing an entry is fine.
+    """
+    PROBE = 8
+
+    def __init__(self, path: str, dim: int, capacity: int):
+        self.dtype = np.dtype([("key", "V16"), ("vec", "<f4", (dim,))])
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # the first worker sizes the file, the others take whatever is there
+            if os.fstat(self.fd).st_size < self.dtype.itemsize:
+                os.ftruncate(self.fd, capacity * self.dtype.itemsize)
+            self.capacity = os.fstat(self.fd).st_size // self.dtype.itemsize
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.slots = np.memmap(path, dtype=self.dtype, mode="r+", shape=(self.capacity,))
+        self.keys = self.slots["key"]
+        self.vectors = self.slots["vec"]
+
+    def _window(self, key: bytes):
+        home = int.from_bytes(key[:8], "little") % self.capacity
+        return [(home + i) % self.capacity for i in range(self.PROBE)]
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        for slot in self._window(key):
+            stored = self.keys[slot].tobytes()
+            if stored == _EMPTY:
+                return None
+            if stored == key:
+                vector = np.array(self.vectors[slot])
+                return vector if self.keys[slot].tobytes() == key else None
+        return None
+
+    def put_many(self, items: list):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            for key, vector in items:
+                window = self._window(key)
+                slot = window[0]
+                for candidate in window:
+                    stored = self.keys[candidate].tobytes()
+                    if stored == key:
+                        slot = None  # another worker got there first
+                        break
+                    if stored == _EMPTY:
+                        slot = candidate
+                        break
+                if slot is None:
+                    continue
+                # key cleared first: a reader never pairs the old key with a half-written vector
+                self.keys[slot] = _EMPTY
+                self.vectors[slot] = vector
+                self.keys[slot] = key
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def used(self) -> int:
+        return int(np.count_nonzero(self.keys != np.void(_EMPTY)))
+
+
+class EmbeddingCache:
+    """In-process LRU in front of the shared disk table, keyed by hash(model + normalized text)"""
+    def __init__(self, model_id: str, dim: int = EMBEDDING_DIM, memory_items: int = EMBED_CACHE_MEMORY_ITEMS,
+                 disk_items: int = EMBED_CACHE_DISK_ITEMS, cache_dir: str = EMBED_CACHE_DIR):
+        self.model_id = model_id
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        safe_id = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_id)
+        self.disk = (DiskEmbeddingStore(os.path.join(cache_dir, f"{safe_id}-{dim}d.bin"), dim, disk_items)
+                     if disk_items > 0 else None)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.compute_s = 0.0
+        self.computed = 0
+
+    def key(self, text: str) -> bytes:
+        return hashlib.blake2b(f"{self.model_id}\x00{normalize(text)}".encode(), digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+        vector = self.disk.get(key) if self.disk is not None else None
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, vector)
+        return vector
+
+    def put_many(self, items: list, compute_s: float, duplicates: int = 0):
+        """Store freshly computed vectors; duplicates = repeats within the batch, served by these as hits"""
+        with self._lock:
+            for key, vector in items:
+                self._remember(key, vector)
+            self.computed += len(items)
+            self.compute_s += compute_s
+            self.memory_hits += duplicates
+        if self.disk is not None:
+            self.disk.put_many(items)
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        vector.setflags(write=False)
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits
+        per_text_s = self.compute_s / self.computed if self.computed else 0.0
+        return {
+            "model": self.model_id,
+            "lookups": lookups,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_items": len(self.memory),
+            "disk_items": self.disk.used() if self.disk is not None else 0,
+            "disk_capacity": self.disk.capacity if self.disk is not None else 0,
+            "avg_embed_ms": round(per_text_s * 1000, 3),
+            # every hit is a model run we didn't do, at the average cost of the ones we did
+            # (unknown until this worker has embedded something itself)
+            "cpu_s_saved": round(hits * per_text_s, 2) if self.computed else None,
+        }
+
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """
+    Wraps the real embedding function so every embedding chroma or we compute goes through the cache.
+    Reports the wrapped function's name/config, so existing collections don't see a different embedder.
+    """
+    def __init__(self, inner, cache: EmbeddingCache):
+        self.inner = inner
+        self.cache = cache
+
+    def __call__(self, input):
+        texts = list(input)
+        vectors = [None] * len(texts)
+        missing = OrderedDict()
+        for i, text in enumerate(texts):
+            key = self.cache.key(text)
+            if key in missing:
+                # duplicates within one batch are embedded once
+                missing[key].append(i)
+                continue
+            vector = self.cache.get(key)
+            if vector is None:
+                missing[key] = [i]
+            else:
+                vectors[i] = vector
+
+        if missing:
+            started = time.perf_counter()
+            computed = self.inner([texts[slots[0]] for slots in missing.values()])
+            elapsed = time.perf_counter() - started
+            items = []
+            for (key, slots), vector in zip(missing.items(), computed):
+                vector = np.asarray(vector, dtype=np.float32)
+                items.append((key, vector))
+                for i in slots:
+                    vectors[i] = vector
+            self.cache.put_many(items, elapsed, duplicates=sum(len(slots) - 1 for slots in missing.values()))
+        return vectors
+
+    def name(self):
+        return self.inner.name()
+
+    def get_config(self):
+        return self.inner.get_config()
+
+    def is_legacy(self) -> bool:
+        return self.inner.is_legacy()
+
+    def default_space(self):
+        return self.inner.default_space()
+
+    def supported_spaces(self):
+        return self.inner.supported_spaces()
+
+
+def with_cache(embedding_fn):
+    """The embedding function to use everywhere: cached unless EMBED_CACHE_ENABLED=false"""
+    if not EMBED_CACHE_ENABLED:
+        return embedding_fn
+    model_id = f"{EMBEDDING_MODEL}-{EMBEDDING_BACKEND}-{embedding_space()['embedding_precision']}"
+    return CachedEmbeddingFunction(embedding_fn, EmbeddingCache(model_id))
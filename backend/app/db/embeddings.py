@@ -0,0 +1,132 @@
+import os
+import logging
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+from chromadb.utils import embedding_functions
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+
+# sentence-transformers (PyTorch) | onnx | onnx-int8
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence-transformers").lower()
+# 0 = let the runtime decide
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+# folder with model.onnx + tokenizer.json, defaults to the copy chroma downloads
+EMBEDDING_ONNX_DIR = os.getenv(
+    "EMBEDDING_ONNX_DIR",
+    os.path.expanduser(f"~/.cache/chroma/onnx_models/{EMBEDDING_MODEL}/onnx")
+)
+# strict = refuse to mix fp32 and int8 vectors of the same model in one store
+EMBEDDING_STRICT = os.getenv("EMBEDDING_STRICT", "false").lower() == "true"
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("sentence-transformers", "onnx", "onnx-int8")
+
+
+class EmbeddingMismatchError(RuntimeError):
+    """A collection was written with vectors from a different embedding space"""
+
+
+class OnnxMiniLMEmbedding(EmbeddingFunction):
+    """
+    all-MiniLM-L6-v2 on ONNX Runtime, no PyTorch needed.
+    Mean pooling + L2 normalisation, same as the sentence-transformers model.
+    With quantized=True the weights are dynamically quantized to int8 (done once, cached on disk).
+    """
+    def __init__(self, model_dir: str = EMBEDDING_ONNX_DIR, quantized: bool = False,
+                 threads: int = EMBEDDING_THREADS, max_length: int = 256):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = os.path.join(model_dir, "model.onnx")
+        if not os.path.exists(model_path):
+            # chroma's own ONNX embedder downloads the exported model on first use
+            embedding_functions.ONNXMiniLM_L6_V2()(["warm up"])
+
+        if quantized:
+            model_path = self._quantize(model_path)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    @staticmethod
+    def _quantize(model_path: str) -> str:
+        int8_path = model_path.replace(".onnx", "_int8.onnx")
+        if not os.path.exists(int8_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            log.info(f"⚙️  Quantizing {model_path} to int8 (one-time)...")
+            tmp = f"{int8_path}.tmp"
+            quantize_dynamic(model_path, tmp, weight_type=QuantType.QInt8)
+            os.replace(tmp, int8_path)
+        return int8_path
+
+    def __call__(self, input):
+        encoded = self.tokenizer.encode_batch(list(input))
+        ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        feeds = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(ids)
+
+        hidden = self.session.run(None, feeds)[0]
+        weights = mask[:, :, None].astype(np.float32)
+        pooled = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+        pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return [row for row in pooled.astype(np.float32)]
+
+
+def make_embedding_function(backend: str = EMBEDDING_BACKEND, threads: int = EMBEDDING_THREADS):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND {backend!r}, pick one of {BACKENDS}")
+
+    if backend == "sentence-transformers":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL)
+
+    return OnnxMiniLMEmbedding(quantized=backend == "onnx-int8", threads=threads)
+
+
+def embedding_space(backend: str = EMBEDDING_BACKEND) -> dict:
+    """What gets stamped on a collection so we know which vectors live in it"""
+    return {
+        "embedding_model": EMBEDDING_MODEL,
+        "embedding_dim": EMBEDDING_DIM,
+        "embedding_precision": "int8" if backend == "onnx-int8" else "fp32",
+    }
+
+
+def check_compatible(collection_name: str, stored: dict, backend: str = EMBEDDING_BACKEND):
+    """
+    Raise if a collection's vectors can't be compared with this backend's.
+    Collections from before the stamp existed were all written by sentence-transformers.
+    fp32 and int8 MiniLM vectors are close enough to mix unless EMBEDDING_STRICT is on.
+    """
+    stored = stored or {}
+    current = embedding_space(backend)
+    stored_model = stored.get("embedding_model", EMBEDDING_MODEL)
+    stored_dim = int(stored.get("embedding_dim", EMBEDDING_DIM))
+    stored_precision = stored.get("embedding_precision", "fp32")
+
+    if stored_model != current["embedding_model"] or stored_dim != current["embedding_dim"]:
+        raise EmbeddingMismatchError(
+            f"{collection_name} holds {stored_model} ({stored_dim}d) vectors but EMBEDDING_BACKEND="
+            f"{backend} produces {current['embedding_model']} ({current['embedding_dim']}d); "
+            f"re-embed the store before switching"
+        )
+    if EMBEDDING_STRICT and stored_precision != current["embedding_precision"]:
+        raise EmbeddingMismatchError(
+            f"{collection_name} holds {stored_precision} vectors, backend {backend} is "
+            f"{current['embedding_precision']} (EMBEDDING_STRICT=true)"
+        )
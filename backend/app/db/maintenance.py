@@ -0,0 +1,84 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import logging
+
+# a segment folder younger than this may belong to a collection that is still being created
+ORPHAN_GRACE_S = float(os.getenv("MAINTENANCE_ORPHAN_GRACE_S", "600"))
+# only VACUUM when at least this fraction of the sqlite file is free pages (VACUUM briefly locks it)
+VACUUM_MIN_FREE = float(os.getenv("MAINTENANCE_VACUUM_MIN_FREE", "0.2"))
+
+log = logging.getLogger(__name__)
+
+_SEGMENT_DIR = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+def dir_size(path: str) -> int:
+    """Bytes used by a file or everything below a folder"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def remove_orphan_segments(chroma_path: str, grace_s: float = ORPHAN_GRACE_S) -> int:
+    """
+    Delete HNSW segment folders no collection points at any more (left behind by
+    deleted collections). Returns bytes reclaimed.
+    """
+    db_path = os.path.join(chroma_path, "chroma.sqlite3")
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    try:
+        known = {row[0] for row in conn.execute("SELECT id FROM segments")}
+    finally:
+        conn.close()
+
+    reclaimed = 0
+    now = time.time()
+    for name in os.listdir(chroma_path):
+        folder = os.path.join(chroma_path, name)
+        if not (_SEGMENT_DIR.match(name) and os.path.isdir(folder)) or name in known:
+            continue
+        if now - os.path.getmtime(folder) < grace_s:
+            continue
+        size = dir_size(folder)
+        shutil.rmtree(folder, ignore_errors=True)
+        if not os.path.exists(folder):
+            reclaimed += size
+            log.info(f"🗑️  Removed orphan segment {name} ({size / 2**20:.1f} MB)")
+    return reclaimed
+
+
+def vacuum_sqlite(path: str, min_free: float = VACUUM_MIN_FREE, force: bool = False) -> int:
+    """
+    Checkpoint the WAL and, when enough of the file is free pages, VACUUM it.
+    Returns bytes reclaimed (main file + WAL).
+    """
+    if not os.path.exists(path):
+        return 0
+    files = [path, f"{path}-wal"]
+    before = sum(os.path.getsize(p) for p in files if os.path.exists(p))
+
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal":
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if pages and (force or free / pages >= min_free):
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+    after = sum(os.path.getsize(p) for p in files if os.path.exists(p))
+    return max(0, before - after)
@@ -0,0 +1,73 @@
+import numpy as np
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+
+def timestamp_of(metadata: dict) -> Optional[float]:
+    """Epoch seconds of a memory: the numeric "ts" field, or its ISO "timestamp" for older rows"""
+    metadata = metadata or {}
+    if metadata.get("ts") is not None:
+        return float(metadata["ts"])
+    stamp = metadata.get("timestamp")
+    if stamp:
+        try:
+            return datetime.fromisoformat(stamp).timestamp()
+        except ValueError:
+            pass
+    return None
+
+
+@dataclass(frozen=True)
+class RecallFilter:
+    """
+    Narrows a recall to some memories: who said it, when (epoch seconds, since inclusive,
+    until exclusive) and which kind of fact it is. Runs inside the store - a chroma
+    where clause, or a mask over the numpy index's field columns - so the top-k is taken
+    from the matching memories only.
+    """
+    role: Optional[str] = None
+    since: Optional[float] = None
+    until: Optional[float] = None
+    fact_types: Optional[tuple] = None
+
+    def is_time_scoped(self) -> bool:
+        return self.since is not None or self.until is not None
+
+    def where(self) -> Optional[dict]:
+        clauses = []
+        if self.role:
+            clauses.append({"role": {"$eq": self.role}})
+        if self.since is not None:
+            clauses.append({"ts": {"$gte": float(self.since)}})
+        if self.until is not None:
+            clauses.append({"ts": {"$lt": float(self.until)}})
+        if self.fact_types:
+            clauses.append({"fact_type": {"$in": list(self.fact_types)}})
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def mask(self, fields: dict) -> np.ndarray:
+        """Rows matching the filter, from an index's columns: ts (float, NaN = unknown), role, fact_type"""
+        keep = np.ones(fields["ts"].shape[0], dtype=bool)
+        if self.role:
+            keep &= fields["role"] == self.role
+        # NaN compares False, so undated rows drop out of time-scoped queries like in chroma
+        if self.since is not None:
+            keep &= fields["ts"] >= self.since
+        if self.until is not None:
+            keep &= fields["ts"] < self.until
+        if self.fact_types:
+            keep &= np.isin(fields["fact_type"], list(self.fact_types))
+        return keep
+
+
+def field_columns(metadatas: list) -> dict:
+    """The filterable metadata of an index as numpy columns"""
+    ts = [timestamp_of(m) for m in metadatas]
+    return {
+        "ts": np.array([np.nan if t is None else t for t in ts], dtype=np.float64),
+        "role": np.array([(m or {}).get("role", "") for m in metadatas], dtype=object),
+        "fact_type": np.array([(m or {}).get("fact_type", "") for m in metadatas], dtype=object),
+    }
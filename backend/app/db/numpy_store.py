@@ -0,0 +1,376 @@
+import os
+import json
+import threading
+import weakref
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+from app.db.embeddings import EMBEDDING_DIM
+from app.db.memory_filters import RecallFilter, field_columns
+
+try:
+    import fcntl
+except ImportError:  # windows: single worker, in-process lock is enough
+    fcntl = None
+
+ROW_BYTES = EMBEDDING_DIM * 4
+PROMOTED_MARKER = "promoted"
+
+
+@contextmanager
+def _shared_lock(folder: str, held: bool = False):
+    """Readers take the user's lock shared while replaying, so a compaction can't swap files mid-read"""
+    if held or fcntl is None:
+        yield
+        return
+    with open(os.path.join(folder, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class UserIndex:
+    """
+    One user's memories: float32 rows in a memory-mapped file plus an append-only JSON log.
+    The log is the source of truth - vectors.f32 rows are only reachable through an "add" record.
+    """
+    def __init__(self, folder: str, locked: bool = False):
+        self.folder = folder
+        self.vectors_path = os.path.join(folder, "vectors.f32")
+        self.log_path = os.path.join(folder, "log.jsonl")
+        self._reset(None)
+        self.refresh(locked)
+
+    def _reset(self, inode):
+        self.ids = []
+        self.docs = []
+        self.metas = []
+        self.rows = []
+        self.deleted = []
+        self.position = {}
+        self.records = 0
+        self.log_offset = 0
+        self.log_inode = inode
+        self.log_head = b""
+        self.matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        self.alive = np.empty(0, dtype=bool)
+        self.fields = field_columns([])
+
+    def refresh(self, locked: bool = False):
+        """Replay any log lines written since last time (possibly by another worker)"""
+        try:
+            stat = os.stat(self.log_path)
+        except OSError:
+            # purged or promoted by another worker: nothing of ours is left on disk
+            if self.log_inode is not None:
+                self._reset(None)
+            return
+        if stat.st_ino == self.log_inode and stat.st_size == self.log_offset:
+            return
+
+        with _shared_lock(self.folder, held=locked):
+            try:
+                stat = os.stat(self.log_path)
+            except OSError:  # purged or promoted meanwhile
+                self._reset(None)
+                return
+            with open(self.log_path, "rb") as f:
+                # inode numbers get reused, so a purged and recreated log is recognised by its first line
+                if (stat.st_ino != self.log_inode or stat.st_size < self.log_offset
+                        or f.read(len(self.log_head)) != self.log_head):
+                    # first read, or the log was compacted / recreated: replay from the start
+                    self._reset(stat.st_ino)
+                f.seek(self.log_offset)
+                chunk = f.read(stat.st_size - self.log_offset)
+            # only consume whole lines, a writer may be mid-append
+            end = chunk.rfind(b"\n") + 1
+            if not self.log_head:
+                self.log_head = chunk[:chunk.find(b"\n") + 1]
+            for line in chunk[:end].splitlines():
+                self._apply(json.loads(line))
+            self.log_offset += end
+            self._remap()
+
+    def _apply(self, record: dict):
+        self.records += 1
+        op = record["op"]
+        if op == "add":
+            if record["id"] in self.position:
+                return
+            self.position[record["id"]] = len(self.ids)
+            self.ids.append(record["id"])
+            self.docs.append(record["doc"])
+            self.metas.append(record.get("meta") or {})
+            self.rows.append(record["row"])
+            self.deleted.append(False)
+        elif op == "del":
+            i = self.position.pop(record["id"], None)
+            if i is not None:
+                self.deleted[i] = True
+        elif op == "meta":
+            i = self.position.get(record["id"])
+            if i is not None:
+                self.metas[i] = record["meta"]
+
+    def _remap(self):
+        rows = np.asarray(self.rows, dtype=np.int64)
+        self.alive = ~np.asarray(self.deleted, dtype=bool)
+        # filterable metadata as columns, so filtered recall is a mask and not a python loop per query
+        self.fields = field_columns(self.metas)
+        n_rows = os.path.getsize(self.vectors_path) // ROW_BYTES if os.path.exists(self.vectors_path) else 0
+        if rows.size == 0 or n_rows == 0:
+            self.matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+            return
+        mapped = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(n_rows, EMBEDDING_DIM))
+        # normally log entry i is row i and we can use the mapping as-is
+        if rows.size == n_rows and np.array_equal(rows, np.arange(n_rows)):
+            self.matrix = mapped
+        else:
+            self.matrix = mapped[rows]
+
+    def count(self) -> int:
+        return int(self.alive.sum())
+
+    def search(self, query: np.ndarray, n_results: int, where: RecallFilter = None):
+        """Exact top-n by cosine (among rows matching where), returned as chroma-style squared L2 distances"""
+        live = np.flatnonzero(self.alive if where is None else self.alive & where.mask(self.fields))
+        if live.size == 0:
+            return [], []
+        sims = self.matrix[live] @ query
+        k = min(n_results, live.size)
+        best = np.argpartition(-sims, k - 1)[:k]
+        best = best[np.argsort(-sims[best], kind="stable")]
+        return live[best].tolist(), (2.0 - 2.0 * sims[best]).tolist()
+
+
+class NumpyMemoryStore:
+    """
+    Brute-force per-user vector store for small memory sets.
+    For a few hundred rows one matrix-vector product beats an HNSW lookup and
+    costs a fraction of the disk/RAM of a chroma collection.
+    """
+    def __init__(self, root: str, max_cached_users: int = 2000):
+        self.root = root
+        self.max_cached_users = max_cached_users
+        self._cache = OrderedDict()
+        # only guards _cache and _user_locks; per-user work (refresh, writes, promotion) takes the user's own lock
+        self._lock = threading.Lock()
+        self._user_locks = weakref.WeakValueDictionary()
+        os.makedirs(root, exist_ok=True)
+
+    def _folder(self, user_id: str) -> str:
+        return os.path.join(self.root, quote(user_id, safe=""))
+
+    def _user_lock(self, user_id: str) -> threading.RLock:
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.RLock()
+            return lock
+
+    def _forget(self, user_id: str):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def _index(self, user_id: str, locked: bool = False) -> UserIndex:
+        """The user's cached index, brought up to date; locked = caller holds the user's flock"""
+        with self._user_lock(user_id):
+            with self._lock:
+                index = self._cache.get(user_id)
+                if index is not None:
+                    self._cache.move_to_end(user_id)
+            if index is None:
+                index = UserIndex(self._folder(user_id), locked)
+                with self._lock:
+                    self._cache[user_id] = index
+                    if len(self._cache) > self.max_cached_users:
+                        self._cache.popitem(last=False)
+            else:
+                index.refresh(locked)
+            return index
+
+    @contextmanager
+    def _writing(self, user_id: str):
+        folder = self._folder(user_id)
+        lock_path = os.path.join(folder, ".lock")
+        with self._user_lock(user_id):
+            while True:
+                try:
+                    os.makedirs(folder, exist_ok=True)
+                    lock_file = open(lock_path, "a")
+                except (FileExistsError, FileNotFoundError):
+                    continue  # the folder was being removed by a purge, go again
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    # a purge in another worker may have unlinked the file we were waiting on
+                    try:
+                        current = os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+                    except OSError:
+                        current = False
+                    if not current:
+                        lock_file.close()
+                        continue
+                break
+            try:
+                yield folder
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    @staticmethod
+    def _append_log(folder: str, records: list):
+        with open(os.path.join(folder, "log.jsonl"), "a") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in records))
+
+    def exists(self, user_id: str) -> bool:
+        return os.path.exists(os.path.join(self._folder(user_id), "log.jsonl"))
+
+    def is_promoted(self, user_id: str) -> bool:
+        return os.path.exists(os.path.join(self._folder(user_id), PROMOTED_MARKER))
+
+    def user_ids(self) -> list:
+        return [unquote(name) for name in os.listdir(self.root)
+                if os.path.exists(os.path.join(self.root, name, "log.jsonl"))]
+
+    def add(self, user_id: str, ids: list, documents: list, metadatas: list, embeddings) -> bool:
+        """Append memories; False if the user has meanwhile been promoted to chroma"""
+        vectors = np.array(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._writing(user_id) as folder:
+            if os.path.exists(os.path.join(folder, PROMOTED_MARKER)):
+                return False
+            # read under the lock, so the same id added by two workers at once is only appended once
+            known = set(self._index(user_id, locked=True).position)
+            vectors_path = os.path.join(folder, "vectors.f32")
+            first_row = os.path.getsize(vectors_path) // ROW_BYTES if os.path.exists(vectors_path) else 0
+            keep = []
+            for i, doc_id in enumerate(ids):
+                if doc_id not in known:
+                    known.add(doc_id)
+                    keep.append(i)
+            if not keep:
+                return True
+            with open(vectors_path, "ab") as f:
+                f.write(vectors[keep].tobytes())
+            self._append_log(folder, [
+                {"op": "add", "id": ids[i], "row": first_row + n, "doc": documents[i], "meta": metadatas[i]}
+                for n, i in enumerate(keep)
+            ])
+        return True
+
+    def delete(self, user_id: str, ids: list):
+        with self._writing(user_id) as folder:
+            self._append_log(folder, [{"op": "del", "id": doc_id} for doc_id in ids])
+
+    def update_metadata(self, user_id: str, ids: list, metadatas: list):
+        with self._writing(user_id) as folder:
+            self._append_log(folder, [{"op": "meta", "id": i, "meta": m} for i, m in zip(ids, metadatas)])
+
+    def count(self, user_id: str) -> int:
+        if not self.exists(user_id):
+            return 0
+        with self._user_lock(user_id):
+            return self._index(user_id).count()
+
+    def query(self, user_id: str, query_embedding, n_results: int, where: RecallFilter = None) -> dict:
+        query = np.array(query_embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        # under the user's lock: a refresh from another thread swaps the index's arrays and lists
+        # one at a time, a search in between would mix old and new
+        with self._user_lock(user_id):
+            index = self._index(user_id)
+            picked, distances = index.search(query, n_results, where)
+            return {
+                "ids": [index.ids[i] for i in picked],
+                "documents": [index.docs[i] for i in picked],
+                "metadatas": [index.metas[i] for i in picked],
+                "distances": distances,
+            }
+
+    def get_all(self, user_id: str, include_embeddings: bool = False) -> dict:
+        with self._user_lock(user_id):
+            index = self._index(user_id)
+            live = np.flatnonzero(index.alive)
+            result = {
+                "ids": [index.ids[i] for i in live],
+                "documents": [index.docs[i] for i in live],
+                "metadatas": [index.metas[i] for i in live],
+            }
+            if include_embeddings:
+                result["embeddings"] = np.array(index.matrix[live])
+        return result
+
+    def promote(self, user_id: str, copy_to) -> int:
+        """
+        Hand a user over to the ANN store: copy_to(data) gets every live memory with
+        its vector, then the marker makes every worker route this user to chroma.
+        """
+        with self._writing(user_id) as folder:
+            self._forget(user_id)
+            data = UserIndex(folder, locked=True)
+            live = np.flatnonzero(data.alive)
+            copy_to({
+                "ids": [data.ids[i] for i in live],
+                "documents": [data.docs[i] for i in live],
+                "metadatas": [data.metas[i] for i in live],
+                "embeddings": np.array(data.matrix[live]),
+            })
+            open(os.path.join(folder, PROMOTED_MARKER), "w").close()
+            for name in ("log.jsonl", "vectors.f32"):
+                os.remove(os.path.join(folder, name))
+        return int(live.size)
+
+    def compact(self, user_id: str) -> int:
+        """
+        Rewrite a user's files with only live memories (deleted rows and superseded
+        log records dropped). New files are swapped in with os.replace, so readers in
+        other workers keep their old mapping until they notice the new log. Returns bytes reclaimed.
+        """
+        with self._writing(user_id) as folder:
+            if os.path.exists(os.path.join(folder, PROMOTED_MARKER)):
+                return 0
+            self._forget(user_id)
+            data = UserIndex(folder, locked=True)
+            live = np.flatnonzero(data.alive)
+            if data.records == live.size:
+                return 0  # no deletions or metadata rewrites to fold in
+            paths = [os.path.join(folder, name) for name in ("vectors.f32", "log.jsonl")]
+            before = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+            with open(paths[0] + ".tmp", "wb") as f:
+                f.write(np.ascontiguousarray(data.matrix[live]).tobytes())
+            with open(paths[1] + ".tmp", "w") as f:
+                f.write("".join(
+                    json.dumps({"op": "add", "id": data.ids[i], "row": n, "doc": data.docs[i], "meta": data.metas[i]}) + "\n"
+                    for n, i in enumerate(live)
+                ))
+            # readers hold the lock shared while replaying, so they see both old files or both new
+            os.replace(paths[0] + ".tmp", paths[0])
+            os.replace(paths[1] + ".tmp", paths[1])
+            after = sum(os.path.getsize(p) for p in paths)
+        return before - after
+
+    def drop(self, user_id: str):
+        """Forget a user entirely (purge)"""
+        folder = self._folder(user_id)
+        self._forget(user_id)
+        if not os.path.isdir(folder):
+            return
+        # under the user's lock, so a concurrent add/compact in another worker either finishes
+        # first or starts after the purge - never leaves half a user behind
+        with self._writing(user_id):
+            self._forget(user_id)
+            for name in ("log.jsonl", "vectors.f32", PROMOTED_MARKER, ".lock"):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except OSError:
+                    pass
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
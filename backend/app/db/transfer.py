@@ -0,0 +1,154 @@
+"""
+Bulk export / import of long-term memories as NDJSON (optionally gzipped).
+
+    python -m app.db.transfer export backup.ndjson.gz
+    python -m app.db.transfer import backup.ndjson.gz
+
+First line is a header with the embedding space, then one memory per line:
+    {"user_id": ..., "id": ..., "doc": ..., "meta": {...}, "emb": "<base64 float32>"}
+"emb" may be left out when seeding a store from plain text; those get embedded on import.
+"""
+
+import gzip
+import json
+import logging
+import time
+import base64
+import argparse
+import numpy as np
+from app.db.embeddings import EMBEDDING_DIM, embedding_space
+from app.db.vector_store import list_user_ids, iter_memories, add_memories_bulk, embed_texts
+from app.core.logging_setup import configure_logging
+
+FORMAT = "stan-memories"
+VERSION = 1
+
+log = logging.getLogger(__name__)
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        # level 1: the vectors barely compress anyway, speed matters more
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=1)
+    return open(path, mode, encoding="utf-8")
+
+
+def _encode(vector) -> str:
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+def _decode(text: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(text), dtype="<f4")
+
+
+def export_memories(path: str, user_ids: list = None, batch_size: int = 1000) -> dict:
+    """Stream every (or the given) user's memories with vectors to path, one page at a time"""
+    started = time.perf_counter()
+    users = memories = 0
+    with _open(path, "w") as out:
+        out.write(json.dumps({"format": FORMAT, "version": VERSION, **embedding_space()}) + "\n")
+        for user_id in user_ids or list_user_ids():
+            users += 1
+            for page in iter_memories(user_id, batch_size):
+                out.write("".join(
+                    json.dumps({"user_id": user_id, "id": doc_id, "doc": doc, "meta": meta or {}, "emb": _encode(vec)}) + "\n"
+                    for doc_id, doc, meta, vec in zip(page["ids"], page["documents"], page["metadatas"], page["embeddings"])
+                ))
+                memories += len(page["ids"])
+    return _stats(users, memories, started)
+
+
+class _Batch:
+    def __init__(self):
+        self.ids, self.docs, self.metas, self.vectors = [], [], [], []
+
+
+def import_memories(path: str, batch_size: int = 1000, reembed: bool = False) -> dict:
+    """
+    Load an export back in with batched inserts. Stored vectors are used as-is unless
+    they come from another embedding space (or reembed=True); missing ones are embedded per batch.
+    """
+    started = time.perf_counter()
+    pending = {}
+    users = set()
+    memories = embedded = 0
+
+    def flush(user_id: str):
+        nonlocal embedded
+        batch = pending.pop(user_id)
+        missing = [i for i, v in enumerate(batch.vectors) if v is None]
+        if missing:
+            for i, vector in zip(missing, embed_texts([batch.docs[i] for i in missing])):
+                batch.vectors[i] = vector
+            embedded += len(missing)
+        add_memories_bulk(user_id, batch.ids, batch.docs, batch.metas, np.asarray(batch.vectors, dtype=np.float32))
+
+    with _open(path, "r") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != FORMAT:
+            raise ValueError(f"{path} is not a {FORMAT} export")
+        current = embedding_space()
+        if not reembed and (header.get("embedding_model") != current["embedding_model"]
+                            or int(header.get("embedding_dim", 0)) != current["embedding_dim"]):
+            log.warning(f"⚠️  {path} holds {header.get('embedding_model')} vectors, re-embedding with "
+                        f"{current['embedding_model']}")
+            reembed = True
+
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            user_id = record["user_id"]
+            batch = pending.get(user_id)
+            if batch is None:
+                batch = pending[user_id] = _Batch()
+                users.add(user_id)
+
+            vector = None
+            if record.get("emb") and not reembed:
+                vector = _decode(record["emb"])
+                if vector.size != EMBEDDING_DIM:
+                    vector = None
+            batch.ids.append(record["id"])
+            batch.docs.append(record["doc"])
+            batch.metas.append(record.get("meta") or {})
+            batch.vectors.append(vector)
+            memories += 1
+
+            if len(batch.ids) >= batch_size:
+                flush(user_id)
+            # interleaved files shouldn't pile up unbounded partial batches
+            if len(pending) > 64:
+                for waiting in list(pending):
+                    flush(waiting)
+
+        for waiting in list(pending):
+            flush(waiting)
+
+    return {**_stats(len(users), memories, started), "embedded": embedded}
+
+
+def _stats(users: int, memories: int, started: float) -> dict:
+    seconds = time.perf_counter() - started
+    return {
+        "users": users,
+        "memories": memories,
+        "seconds": round(seconds, 2),
+        "memories_per_s": round(memories / seconds) if seconds else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("path", help="NDJSON file, gzipped if it ends in .gz")
+    parser.add_argument("--users", nargs="+", help="export only these user ids")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--reembed", action="store_true", help="ignore stored vectors and embed every memory again")
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.action == "export":
+        print(export_memories(args.path, args.users, args.batch))
+    else:
+        print(import_memories(args.path, args.batch, args.reembed))
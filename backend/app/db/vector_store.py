@@ -1,21 +1,118 @@
+import os
+import logging
 import chromadb
-from chromadb.utils import embedding_functions
+import numpy as np
+from app.db.embeddings import make_embedding_function, embedding_space, check_compatible
+from app.db.embedding_cache import with_cache
+from app.db.memory_filters import RecallFilter
+from app.db.numpy_store import NumpyMemoryStore
 
-client = chromadb.PersistentClient(path="./chroma_memory")
+CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma_memory")
 
-embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+# chroma = every user gets an HNSW collection
+# numpy  = small users live in brute-force numpy files, promoted to chroma past NUMPY_PROMOTE_AT
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma").lower()
+NUMPY_STORE_PATH = os.getenv("NUMPY_STORE_PATH", "./numpy_memory")
+NUMPY_PROMOTE_AT = int(os.getenv("NUMPY_PROMOTE_AT", "300"))
+
+log = logging.getLogger(__name__)
+
+client = chromadb.PersistentClient(path=CHROMA_PATH)
+
+# every embedding (ours and the ones chroma computes from query_texts/documents) goes through the cache
+embedding_fn = with_cache(make_embedding_function())
+
+numpy_store = NumpyMemoryStore(NUMPY_STORE_PATH) if VECTOR_BACKEND == "numpy" else None
+
+# collections already checked against the active embedding backend in this process
+_verified_collections = set()
 
 def get_user_collection(user_id: str):
-    return client.get_or_create_collection(
-        name=f"user_{user_id}",
-        embedding_function=embedding_fn
-    )
+    name = f"user_{user_id}"
+    try:
+        collection = client.get_collection(name=name, embedding_function=embedding_fn)
+    except Exception:
+        # new collections get stamped with the embedding space that filled them
+        collection = client.get_or_create_collection(
+            name=name,
+            embedding_function=embedding_fn,
+            metadata=embedding_space()
+        )
+
+    if name not in _verified_collections:
+        check_compatible(name, collection.metadata)
+        _verified_collections.add(name)
+    return collection
+
+def _has_collection(user_id: str) -> bool:
+    try:
+        client.get_collection(name=f"user_{user_id}", embedding_function=embedding_fn)
+        return True
+    except Exception:
+        return False
+
+# per-user write counter so caches can tell when a user's memories changed
+_memory_versions = {}
+
+def memory_version(user_id: str) -> int:
+    return _memory_versions.get(user_id, 0)
+
+def _bump_version(user_id: str):
+    _memory_versions[user_id] = _memory_versions.get(user_id, 0) + 1
+
+# users known to live in chroma (promoted or pre-existing), that never changes back
+_chroma_users = set()
+
+def _on_numpy(user_id: str) -> bool:
+    """Which store holds this user: numpy until promoted, chroma for legacy/promoted users"""
+    if numpy_store is None or user_id in _chroma_users:
+        return False
+    if numpy_store.exists(user_id):
+        return True
+    if numpy_store.is_promoted(user_id) or _has_collection(user_id):
+        _chroma_users.add(user_id)
+        return False
+    return True
+
+def _promote(user_id: str):
+    def copy_to(data: dict):
+        if data["ids"]:
+            get_user_collection(user_id).add(
+                ids=data["ids"],
+                documents=data["documents"],
+                metadatas=data["metadatas"],
+                embeddings=[list(map(float, v)) for v in data["embeddings"]]
+            )
+    moved = numpy_store.promote(user_id, copy_to)
+    log.info(f"📈 {user_id} promoted to chroma HNSW index ({moved} memories)", extra={"memories": moved})
+
+def embed_texts(texts: list) -> list:
+    """Embed many texts in one model call (batch endpoint pre-computes everything up front)"""
+    if not texts:
+        return []
+    return list(embedding_fn(list(texts)))
+
+def add_memory(user_id: str, text: str, metadata: dict, embedding=None):
+    doc_id = f"{user_id}_{metadata.get('turn_id', 0)}"
+
+    if _on_numpy(user_id):
+        vector = embedding if embedding is not None else embed_texts([text])[0]
+        nearest = numpy_store.query(user_id, vector, 1)["documents"]
+        if nearest and (text in nearest[0] or nearest[0] == text):
+            return
+        if numpy_store.add(user_id, [doc_id], [text], [metadata], [vector]):
+            _bump_version(user_id)
+            if numpy_store.count(user_id) >= NUMPY_PROMOTE_AT:
+                _promote(user_id)
+            return
+        # another worker promoted this user in the meantime, carry on with chroma
 
-def add_memory(user_id: str, text: str, metadata: dict):
     collection = get_user_collection(user_id)
+    # with a precomputed vector chroma never has to run the model for this text
+    vector = {"query_embeddings": [embedding]} if embedding is not None else {"query_texts": [text]}
 
     try:
-        existing = collection.query(query_texts=[text], n_results=1)
+        existing = collection.query(n_results=1, **vector)
         docs = existing.get("documents", [[]])[0]
         if docs:
             if text in docs[0] or docs[0] == text:
@@ -23,14 +120,211 @@ def add_memory(user_id: str, text: str, metadata: dict):
     except Exception:
         pass
 
-    doc_id = f"{user_id}_{metadata.get('turn_id', 0)}"
     collection.add(
         ids=[doc_id],
         documents=[text],
-        metadatas=[metadata]
+        metadatas=[metadata],
+        **({"embeddings": [embedding]} if embedding is not None else {})
+    )
+    _bump_version(user_id)
+
+def add_memories(user_id: str, texts: list, metadatas: list, embeddings: list):
+    """
+    add_memory for many memories of one user: one near-duplicate query and one insert for all of them.
+    Texts already stored (or repeated within the call) are skipped like add_memory does.
+    """
+    missing = [i for i, vector in enumerate(embeddings) if vector is None]
+    if missing:
+        embeddings = list(embeddings)
+        for i, vector in zip(missing, embed_texts([texts[i] for i in missing])):
+            embeddings[i] = vector
+
+    if _on_numpy(user_id):
+        nearest = [numpy_store.query(user_id, vector, 1)["documents"] for vector in embeddings]
+    else:
+        try:
+            nearest = get_user_collection(user_id).query(
+                query_embeddings=list(embeddings), n_results=1
+            ).get("documents") or [[] for _ in texts]
+        except Exception:
+            nearest = [[] for _ in texts]
+
+    keep, seen = [], set()
+    for i, text in enumerate(texts):
+        docs = nearest[i]
+        if text in seen or (docs and (text in docs[0] or docs[0] == text)):
+            continue
+        seen.add(text)
+        keep.append(i)
+    add_memories_bulk(
+        user_id,
+        [f"{user_id}_{metadatas[i].get('turn_id', 0)}" for i in keep],
+        [texts[i] for i in keep],
+        [metadatas[i] for i in keep],
+        [embeddings[i] for i in keep]
     )
 
-def retrieve_memories(user_id: str, query: str, top_k: int = 3):
+def has_untagged_memories(user_id: str) -> bool:
+    """
+    Chroma memories written before the numeric ts field existed, which time-scoped where clauses can't see.
+    Always False for numpy users: their time filter falls back to the ISO timestamp by itself.
+    """
+    if _on_numpy(user_id) or not _has_collection(user_id):
+        return False
+    collection = get_user_collection(user_id)
+    total = collection.count()
+    return total > 0 and len(collection.get(where={"ts": {"$gte": 0.0}}, include=[])["ids"]) < total
+
+def retrieve_memories(user_id: str, query: str, top_k: int = 3, where: RecallFilter = None):
+    if _on_numpy(user_id):
+        return query_memories(user_id, query, top_k, where=where)["documents"]
+    collection = get_user_collection(user_id)
+    results = collection.query(query_texts=[query], n_results=top_k, where=where.where() if where else None)
+    return results.get("documents", [[]])[0]
+
+def query_memories(user_id: str, query: str, n_results: int = 12, query_embedding=None,
+                   where: RecallFilter = None) -> dict:
+    """
+    Like retrieve_memories but keeps ids, distances and metadata for re-ranking.
+    where narrows the search inside the store (chroma where clause / numpy field mask).
+    """
+    if _on_numpy(user_id):
+        if query_embedding is None:
+            query_embedding = embed_texts([query])[0]
+        return numpy_store.query(user_id, query_embedding, n_results, where)
+
     collection = get_user_collection(user_id)
-    results = collection.query(query_texts=[query], n_results=top_k)
-    return results.get("documents", [[]])[0]
\ No newline at end of file
+    vector = {"query_embeddings": [query_embedding]} if query_embedding is not None else {"query_texts": [query]}
+    results = collection.query(
+        **vector,
+        n_results=n_results,
+        where=where.where() if where else None,
+        include=["documents", "metadatas", "distances"]
+    )
+    return {
+        "ids": results.get("ids", [[]])[0],
+        "documents": results.get("documents", [[]])[0],
+        "metadatas": results.get("metadatas", [[]])[0],
+        "distances": results.get("distances", [[]])[0],
+    }
+
+def list_user_ids():
+    """All user ids that have a long-term collection"""
+    user_ids = []
+    for col in client.list_collections():
+        # older chroma returns Collection objects, 0.6 returns plain names
+        name = getattr(col, "name", col)
+        if name.startswith("user_"):
+            user_ids.append(name[len("user_"):])
+    if numpy_store is not None:
+        known = set(user_ids)
+        user_ids.extend(u for u in numpy_store.user_ids() if u not in known)
+    return user_ids
+
+def iter_memories(user_id: str, batch_size: int = 1000):
+    """A user's memories with their vectors, batch_size at a time, so exports run in bounded memory"""
+    if _on_numpy(user_id):
+        # numpy users are small by construction (< NUMPY_PROMOTE_AT)
+        data = numpy_store.get_all(user_id, include_embeddings=True)
+        for start in range(0, len(data["ids"]), batch_size):
+            yield {key: value[start:start + batch_size] for key, value in data.items()}
+        return
+
+    collection = get_user_collection(user_id)
+    offset = 0
+    while True:
+        page = collection.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+        if not page["ids"]:
+            return
+        yield {
+            "ids": page["ids"],
+            "documents": page["documents"],
+            "metadatas": page["metadatas"],
+            "embeddings": page["embeddings"],
+        }
+        offset += len(page["ids"])
+
+def add_memories_bulk(user_id: str, ids: list, documents: list, metadatas: list, embeddings):
+    """
+    Batched insert for imports: no per-memory near-duplicate query, and ids that
+    already exist are not duplicated, so importing the same file twice is safe.
+    """
+    if not ids:
+        return
+    if _on_numpy(user_id):
+        if numpy_store.add(user_id, ids, documents, metadatas, embeddings):
+            _bump_version(user_id)
+            if numpy_store.count(user_id) >= NUMPY_PROMOTE_AT:
+                _promote(user_id)
+            return
+
+    collection = get_user_collection(user_id)
+    # looking ids up is ~100x cheaper than letting chroma re-index them
+    known = set(collection.get(ids=list(ids), include=[])["ids"])
+    keep = [i for i, doc_id in enumerate(ids) if doc_id not in known]
+    if not keep:
+        return
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    collection.add(
+        ids=[ids[i] for i in keep],
+        documents=[documents[i] for i in keep],
+        metadatas=[metadatas[i] or None for i in keep],
+        embeddings=vectors[keep]
+    )
+    _bump_version(user_id)
+
+def get_all_memories(user_id: str, include_embeddings: bool = False):
+    """Every stored memory for a user as parallel lists (ids, documents, metadatas[, embeddings])"""
+    if _on_numpy(user_id):
+        return numpy_store.get_all(user_id, include_embeddings)
+    collection = get_user_collection(user_id)
+    include = ["documents", "metadatas"]
+    if include_embeddings:
+        include.append("embeddings")
+    return collection.get(include=include)
+
+def count_memories(user_id: str) -> int:
+    if _on_numpy(user_id):
+        return numpy_store.count(user_id)
+    return get_user_collection(user_id).count()
+
+def delete_memories(user_id: str, ids: list):
+    if not ids:
+        return
+    if _on_numpy(user_id):
+        numpy_store.delete(user_id, list(ids))
+    else:
+        get_user_collection(user_id).delete(ids=list(ids))
+    _bump_version(user_id)
+
+def update_memory_metadata(user_id: str, ids: list, metadatas: list):
+    if not ids:
+        return
+    if _on_numpy(user_id):
+        numpy_store.update_metadata(user_id, list(ids), list(metadatas))
+    else:
+        get_user_collection(user_id).update(ids=list(ids), metadatas=list(metadatas))
+    _bump_version(user_id)
+
+def purge_user(user_id: str) -> int:
+    """Permanently delete everything stored for a user, in whichever store(s) it lives. Returns memories removed."""
+    removed = 0
+    if numpy_store is not None and numpy_store.exists(user_id):
+        removed += numpy_store.count(user_id)
+    if numpy_store is not None:
+        numpy_store.drop(user_id)
+
+    name = f"user_{user_id}"
+    if _has_collection(user_id):
+        removed += get_user_collection(user_id).count()
+        client.delete_collection(name=name)
+    _verified_collections.discard(name)
+    _chroma_users.discard(user_id)
+    _bump_version(user_id)
+    return removed
+
+def compact_user(user_id: str) -> int:
+    """Fold deletes/metadata rewrites out of a numpy user's files; chroma reuses freed slots on its own"""
+    if _on_numpy(user_id) and numpy_store.exists(user_id):
+        return numpy_store.compact(user_id)
+    return 0
@@ -1,5 +1,11 @@
 from fastapi import FastAPI
 from app.routers import chat
+import asyncio
+from app.core.llm_client import ledger, log_provider_info
+from app.core.logging_setup import CorrelationIdMiddleware, configure_logging, shutdown_logging
+from app.core.memory_consolidation import CONSOLIDATION_ENABLED, consolidation_loop
+from app.core.retention import MAINTENANCE_INTERVAL_S, maintenance_loop
+from app.core.profiling import PROFILE_CONTINUOUS_HZ, profiler
 
 app = FastAPI(
     title="STAN Conversational AI Backend",
@@ -8,6 +14,40 @@ app = FastAPI(
 )
 
 app.include_router(chat.router)
+app.add_middleware(CorrelationIdMiddleware)
+
+@app.on_event("startup")
+def start_logging():
+    configure_logging()
+    log_provider_info()
+
+@app.on_event("startup")
+def prune_quota_ledger():
+    ledger.prune()
+
+@app.on_event("startup")
+async def start_memory_consolidation():
+    if CONSOLIDATION_ENABLED:
+        asyncio.create_task(consolidation_loop())
+
+@app.on_event("startup")
+async def start_storage_maintenance():
+    if MAINTENANCE_INTERVAL_S > 0:
+        asyncio.create_task(maintenance_loop())
+
+@app.on_event("startup")
+def start_continuous_profiler():
+    if PROFILE_CONTINUOUS_HZ > 0:
+        profiler.start()
+
+@app.on_event("shutdown")
+def flush_continuous_profile():
+    if PROFILE_CONTINUOUS_HZ > 0:
+        profiler.flush_continuous()
+
+@app.on_event("shutdown")
+def stop_logging():
+    shutdown_logging()
 
 @app.get("/")
 def root():
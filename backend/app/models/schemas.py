@@ -1,10 +1,17 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Optional, List
 
 class ChatRequest(BaseModel):
     user_id: str
     message: str
+    # optional end-to-end budget for this turn, capped by the server's TURN_DEADLINE_S
+    deadline_ms: Optional[int] = Field(None, ge=1)
+    # same as the Idempotency-Key header: a retry with the same key gets the first attempt's reply
+    idempotency_key: Optional[str] = None
 
 class ChatResponse(BaseModel):
     reply: str
     metadata: Optional[dict] = None
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
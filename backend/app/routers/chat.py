@@ -1,26 +1,127 @@
-from fastapi import APIRouter, HTTPException
-from app.models.schemas import ChatRequest, ChatResponse
+import os
+import json
+import math
+import asyncio
+import logging
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
+from pydantic import ValidationError
+from app.models.schemas import ChatRequest, ChatResponse, BatchChatRequest
 from app.core.memory_manager import MemoryManager
 from app.core.prompt_templates import build_prompt
-from app.core.llm_client import generate
+from app.core.message_analysis import MessageAnalysis, analyze_message
+from app.core.deadline import Deadline, DeadlineExceeded, RECALL_MIN_BUDGET_S, GENERATE_RESERVE_S
+from app.core.quota_ledger import QuotaExceeded
+from app.core.fair_share import ClientThrottled
+from app.db.vector_store import embed_texts, embedding_fn
+from app.core.llm_client import (
+    generate, usage_tracker, estimate_tokens, cancel_stats, record_cancel, FallbackReply, StreamInterrupted
+)
+from app.core.generation_policy import settings_for, output_token_stats
+from app.core.model_tiers import route, tier_stats
+from app.core.retrieval_gate import recall_gate
+from app.core.turn_sequencer import turn_sequencer
+from app.core.hedging import latency_tracker, hedge_budget
+from app.core.fair_share import fair_share
+from app.core.profiling import profiler, PROFILE_TOKEN
+from app.core.logging_setup import log_stats, request_id
+from app.core.idempotency import (
+    IdempotencyConflict, IDEMPOTENCY_KEY_MAX_LEN, fingerprint, idempotency_store
+)
+from app.core.memory_consolidation import last_report
 
 router = APIRouter(prefix="/api/v1", tags=["Chat"])
 memory = MemoryManager()
+
+log = logging.getLogger(__name__)
 turn_counter: dict = {}
 
-@router.post("/message", response_model=ChatResponse)
-async def handle_message(request: ChatRequest):
-    user_id = request.user_id
-    user_message = request.message
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "2000"))
+# how many users a batch runs at once (provider rate limits still apply on top)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
+# websocket sessions are closed after this long without a message
+WS_IDLE_TIMEOUT_S = float(os.getenv("WS_IDLE_TIMEOUT_S", "300"))
+WS_MAX_MESSAGE_CHARS = int(os.getenv("WS_MAX_MESSAGE_CHARS", "4000"))
+# messages a client can send ahead while its current turn is still running
+WS_MAX_QUEUED = int(os.getenv("WS_MAX_QUEUED", "8"))
+ws_stats = {"open": 0, "opened": 0, "idle_closed": 0, "turns": 0, "token_frames": 0, "frames_rejected": 0}
+
+class ClientGone(Exception):
+    """The client disconnected before its turn finished, the turn was cancelled"""
+
+async def _cancel_on_disconnect(work, disconnected: asyncio.Future):
+    """Await work unless the client goes away first - then cancel it (down into the provider call) and raise ClientGone"""
+    task = asyncio.ensure_future(work)
+    try:
+        await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if task.done():
+        return task.result()
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+    raise ClientGone()
+
+async def _wait_for_disconnect(request: Request):
+    # the body is already read, so the next ASGI message is the disconnect
+    # (or the server telling us the response went out)
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+async def _recall_within(deadline: Deadline, user_id: str, user_message: str, top_k: int, query_embedding=None,
+                         filters=None) -> str:
+    """Long-term recall is optional - skip it, or give up on it, when the turn is short on time"""
+    if not deadline.allows(RECALL_MIN_BUDGET_S):
+        log.info(f"⏱️  Skipping recall, only {deadline.remaining():.1f}s left", extra={"sample": "deadline"})
+        return ""
+    try:
+        return await asyncio.wait_for(
+            asyncio.to_thread(memory.recall_context, user_id, user_message, top_k, query_embedding, filters),
+            timeout=deadline.budget(RECALL_MIN_BUDGET_S, keep=GENERATE_RESERVE_S)
+        )
+    except asyncio.TimeoutError:
+        log.info(f"⏱️  Recall for {user_id} too slow, answering without it", extra={"sample": "deadline"})
+        return ""
+
+async def run_turn(user_id: str, user_message: str, analysis: MessageAnalysis = None,
+                   query_embedding=None, fact_embedding=None, deadline: Deadline = None,
+                   api_key: Optional[str] = None, on_token=None, batch: bool = False,
+                   memory_writes: Optional[list] = None) -> ChatResponse:
+    """
+    One full chat turn. Embeddings can be passed in when the caller already batched them.
+    on_token (async, str) receives the reply as it streams in from the provider.
+    batch = the turn comes from /messages/batch and uses the client's batch bucket.
+    memory_writes collects the long-term write instead of storing it (the batch stores a user's all at once).
+    No provider slot (throttled, out of quota, out of time) is an HTTP 429 with Retry-After.
+    """
+    deadline = deadline or Deadline.for_request()
 
     turn_counter[user_id] = turn_counter.get(user_id, 0) + 1
     turn_id = turn_counter[user_id]
 
-    # Save user message
-    memory.save_interaction(user_id, user_message, turn_id, is_user=True)
+    # Scan the message once, everything below reuses the result
+    analysis = analysis or analyze_message(user_message)
+    # small talk and quick answers to STAN's own question don't need long-term memory
+    top_k = recall_gate.plan(analysis, memory.last_reply(user_id))
 
-    # Get relevant memories (increase from 2 to 4 for better recall)
-    retrieved = memory.recall_context(user_id, user_message, top_k=6)  
+    try:
+        # Save user message
+        await asyncio.to_thread(memory.save_interaction, user_id, user_message, turn_id, True,
+                                analysis, fact_embedding, memory_writes)
+
+        # Get relevant memories (increase from 2 to 4 for better recall)
+        retrieved = await _recall_within(deadline, user_id, user_message, top_k, query_embedding,
+                                         recall_gate.scope(analysis)) if top_k else ""
+    except asyncio.CancelledError:
+        cancel_stats["turns"] += 1
+        cancel_stats["provider_calls_saved"] += 1
+        record_cancel("memory")
+        raise
 
     # Actually get recent conversation context
     recent = memory.get_recent_context(user_id)
@@ -32,23 +133,417 @@ async def handle_message(request: ChatRequest):
         user_message=user_message
     )
 
+    # reply length / creativity by what kind of turn this is
+    settings = settings_for(analysis.turn_type)
+
     try:
         llm_reply = await generate(
             prompt=prompt, 
             user_message=user_message,  # Pass for search detection
-            max_tokens=256,      
-            temperature=0.7
+            search_intent=analysis.search_intent,
+            max_tokens=settings["max_tokens"],
+            temperature=settings["temperature"],
+            model=settings.get("model"),
+            # short casual turns go to the provider's small model, unless the policy pinned one
+            tier=route(analysis),
+            deadline=deadline,
+            user_id=user_id,
+            api_key=api_key,
+            on_token=on_token,
+            batch=batch
         )
+    except asyncio.CancelledError:
+        # generate() already counted where it was stopped; no reply to store
+        cancel_stats["turns"] += 1
+        raise
+    except (ClientThrottled, QuotaExceeded, DeadlineExceeded) as e:
+        # not a reply, so nothing goes into memory; the client retries after Retry-After
+        retry_after = getattr(e, "retry_after", None) or 1
+        raise HTTPException(status_code=429, detail=str(e) or "No time left for this turn",
+                            headers={"Retry-After": str(math.ceil(retry_after))})
+    except StreamInterrupted:
+        # the client already has part of a reply; the socket reports it, STAN keeps none of it
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM generation failed: {e}")
 
+    # a fallback ("Taking too long to think...") isn't model output: it would skew the token
+    # stats and STAN would later read it back as something it said
+    if isinstance(llm_reply, FallbackReply):
+        # flagged in metadata, the str subclass doesn't survive ChatResponse
+        return ChatResponse(reply=llm_reply, metadata={"turn_id": turn_id, "fallback": True})
+
+    output_token_stats.record(analysis.turn_type, settings["max_tokens"], estimate_tokens(llm_reply))
+
     # Save STAN's response
     memory.save_interaction(user_id, llm_reply, turn_id, is_user=False)
 
     return ChatResponse(reply=llm_reply, metadata={"turn_id": turn_id})
 
+def _burst_args(requests: list) -> dict:
+    """
+    One turn's args for a merged burst: the first request's, but streaming to every
+    requester that listens for tokens and running until the latest deadline among them
+    """
+    turn_args = dict(requests[0])
+    relays = [r["on_token"] for r in requests if r.get("on_token")]
+    if len(relays) > 1:
+        async def fan_out(text: str):
+            for relay in relays:
+                await relay(text)
+        turn_args["on_token"] = fan_out
+    elif relays:
+        turn_args["on_token"] = relays[0]
+    deadlines = [r["deadline"] for r in requests if r.get("deadline")]
+    if deadlines:
+        turn_args["deadline"] = max(deadlines, key=lambda d: d.expires_at)
+    return turn_args
+
+async def _sequenced_turn(user_id: str, user_message: str, coalesce: bool = True, **turn_args) -> ChatResponse:
+    """run_turn queued behind the user's earlier turns; inside TURN_COALESCE_WINDOW_MS a burst shares one turn"""
+    response, burst_size, position = await turn_sequencer.submit(
+        user_id, user_message, lambda text, requests: run_turn(user_id, text, **_burst_args(requests)), coalesce,
+        # the turn is billed to one client, so only requests under the same API key are merged
+        group=turn_args.get("api_key"), context=turn_args
+    )
+    if burst_size > 1:
+        response = ChatResponse(reply=response.reply, metadata={
+            **(response.metadata or {}), "coalesced": burst_size, "burst_position": position
+        })
+    return response
+
+async def _run_keyed(key: str, user_id: str, user_message: str, **turn_args) -> ChatResponse:
+    """run_turn at most once per (user, key); retries join it or get its stored reply"""
+    if len(key) > IDEMPOTENCY_KEY_MAX_LEN:
+        raise HTTPException(status_code=400, detail=f"Idempotency key longer than {IDEMPOTENCY_KEY_MAX_LEN} chars")
+    try:
+        response, replayed = await idempotency_store.run(
+            user_id, key, fingerprint(user_message), lambda: _sequenced_turn(user_id, user_message, **turn_args),
+            # a fallback says "try again", so the retry has to get a fresh turn, not the same text
+            replayable=lambda response: not (response.metadata or {}).get("fallback")
+        )
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if replayed:
+        response = ChatResponse(reply=response.reply, metadata={**(response.metadata or {}), "idempotent_replay": True})
+    return response
+
+@router.post("/message", response_model=ChatResponse)
+async def handle_message(request: ChatRequest, raw_request: Request, x_api_key: Optional[str] = Header(None),
+                         x_profile: Optional[str] = Header(None),
+                         idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    deadline = Deadline.for_request(request.deadline_ms)
+    key = idempotency_key or request.idempotency_key
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(raw_request))
+    try:
+        # a keyed turn outlives its request, the client is expected to come back for the reply
+        turn = (_run_keyed(key, request.user_id, request.message, deadline=deadline, api_key=x_api_key) if key
+                else _sequenced_turn(request.user_id, request.message, deadline=deadline, api_key=x_api_key))
+        if not profiler.wants(x_profile):
+            return await _cancel_on_disconnect(turn, disconnected)
+
+        with profiler.profile_request(request.user_id) as profile:
+            response = await _cancel_on_disconnect(turn, disconnected)
+        # a copy: a keyed turn's response is also the one replayed to later retries
+        return ChatResponse(reply=response.reply, metadata={**(response.metadata or {}), "profile": profile.path})
+    except StreamInterrupted as e:
+        # only when this request was merged into a streaming socket's burst
+        raise HTTPException(status_code=502, detail=str(e))
+    except ClientGone:
+        # nobody is reading this; 499 is what proxies log for "client closed request"
+        log.info(f"🔌 {request.user_id} disconnected, " + ("reply kept for a retry" if key else "turn cancelled"))
+        return Response(status_code=499)
+    finally:
+        disconnected.cancel()
+
+@router.post("/messages/batch")
+async def handle_batch(request: BatchChatRequest, x_api_key: Optional[str] = Header(None)):
+    """
+    Run many (user_id, message) turns in one call, streamed back as NDJSON.
+    Different users run concurrently, each user's turns keep their order.
+    Lines arrive in completion order; "index" points back into the request.
+    """
+    items = request.items
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {BATCH_MAX_ITEMS} items)")
+
+    analyses = [analyze_message(item.message) for item in items]
+
+    # one embedding call for every query and every fact that will be stored
+    fact_slots = [i for i, a in enumerate(analyses) if a.save_worthy and a.fact]
+    texts = [item.message for item in items] + [analyses[i].fact for i in fact_slots]
+    vectors = await asyncio.to_thread(embed_texts, texts)
+    query_vectors = vectors[:len(items)]
+    fact_vectors = dict(zip(fact_slots, vectors[len(items):]))
+
+    per_user = {}
+    for i, item in enumerate(items):
+        per_user.setdefault(item.user_id, []).append(i)
+
+    results = asyncio.Queue()
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_user(indices: list):
+        # the user's long-term writes go out together after their last turn: one duplicate check, one insert
+        # (a later item still sees the earlier ones through the short-term buffer)
+        writes = []
+        async with slots:
+            try:
+                await run_items(indices, writes)
+            finally:
+                if writes:
+                    await asyncio.shield(asyncio.to_thread(memory.save_pending, items[indices[0]].user_id, writes))
+
+    async def run_items(indices: list, writes: list):
+        for i in indices:
+            item = items[i]
+            turn_args = dict(
+                analysis=analyses[i],
+                query_embedding=query_vectors[i],
+                fact_embedding=fact_vectors.get(i),
+                deadline=Deadline.for_request(item.deadline_ms),
+                api_key=x_api_key,
+                batch=True,
+                memory_writes=writes,
+                # precomputed analysis/embeddings are per message, so no merging here
+                coalesce=False
+            )
+            try:
+                if item.idempotency_key:
+                    response = await _run_keyed(item.idempotency_key, item.user_id, item.message, **turn_args)
+                else:
+                    response = await _sequenced_turn(item.user_id, item.message, **turn_args)
+                line = {"index": i, "user_id": item.user_id,
+                        "reply": response.reply, "metadata": response.metadata}
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                line = {"index": i, "user_id": item.user_id, "error": detail}
+                retry_after = (getattr(e, "headers", None) or {}).get("Retry-After")
+                if retry_after:
+                    line["retry_after"] = int(retry_after)
+            await results.put(line)
+
+    tasks = [asyncio.create_task(run_user(indices)) for indices in per_user.values()]
+
+    async def stream():
+        try:
+            for _ in range(len(items)):
+                line = await results.get()
+                yield json.dumps(line) + "\n"
+        finally:
+            # client went away mid-stream - don't keep burning quota
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+class TokenRelay:
+    """
+    Forwards streamed reply pieces to a websocket without ever blocking the provider stream.
+    Pieces pile up while a send is in flight and go out together as one frame,
+    so a slow client gets fewer, bigger frames instead of an unbounded per-token queue.
+    """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.pending = []
+        self.ready = asyncio.Event()
+        self.done = False
+        self.task = asyncio.create_task(self._send_loop())
+
+    async def push(self, text: str):
+        self.pending.append(text)
+        self.ready.set()
+
+    async def _send_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            if self.pending:
+                text = "".join(self.pending)
+                self.pending.clear()
+                await self.websocket.send_json({"type": "token", "text": text})
+                ws_stats["token_frames"] += 1
+            if self.done and not self.pending:
+                return
+
+    async def close(self):
+        self.done = True
+        self.ready.set()
+        await self.task
+
+async def _read_socket(websocket: WebSocket, inbox: asyncio.Queue, gone: asyncio.Future):
+    """
+    The only reader of the socket: queues incoming frames while a turn runs,
+    and notices a disconnect right away instead of at the next receive.
+    """
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            try:
+                # never wait for room: this loop has to keep receiving to notice a disconnect mid-turn
+                inbox.put_nowait(message.get("text") or message.get("bytes") or "")
+            except asyncio.QueueFull:
+                ws_stats["frames_rejected"] += 1
+                await websocket.send_json({"type": "error", "detail": f"Too many messages queued (max {WS_MAX_QUEUED}), "
+                                                                      "wait for the current reply"})
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        if not gone.done():
+            gone.set_result(None)
+        while not inbox.empty():
+            inbox.get_nowait()
+        inbox.put_nowait(None)
+
+@router.websocket("/ws")
+async def chat_socket(websocket: WebSocket, user_id: str):
+    """
+    One long-lived chat session per connection.
+    Client sends {"message": ..., "deadline_ms"?: ...}; server answers with
+    {"type": "token", "text": ...} frames while the reply streams, then {"type": "done", "reply", "metadata"}.
+    Closing the socket mid-turn cancels the turn.
+    """
+    api_key = websocket.headers.get("x-api-key")
+    await websocket.accept()
+    ws_stats["open"] += 1
+    ws_stats["opened"] += 1
+    inbox = asyncio.Queue(maxsize=WS_MAX_QUEUED)
+    gone = asyncio.get_running_loop().create_future()
+    reader = asyncio.create_task(_read_socket(websocket, inbox, gone))
+    connection_id, turn_no = request_id.get(), 0
+    try:
+        while True:
+            try:
+                raw = await asyncio.wait_for(inbox.get(), WS_IDLE_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                ws_stats["idle_closed"] += 1
+                await websocket.close(code=1000, reason="idle timeout")
+                return
+            if raw is None:
+                return
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                await websocket.send_json({"type": "error", "detail": "Messages must be JSON"})
+                continue
+            if not isinstance(data, dict):
+                await websocket.send_json({"type": "error", "detail": "Messages must be JSON objects"})
+                continue
+            try:
+                # same rules as POST /message; the user comes from the connection
+                frame = ChatRequest(user_id=user_id, message=data.get("message"), deadline_ms=data.get("deadline_ms"))
+            except ValidationError as e:
+                detail = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                await websocket.send_json({"type": "error", "detail": detail})
+                continue
+
+            message = frame.message.strip()
+            if not message or len(message) > WS_MAX_MESSAGE_CHARS:
+                await websocket.send_json({"type": "error", "detail": f"Send a message of 1-{WS_MAX_MESSAGE_CHARS} chars"})
+                continue
+
+            # each turn on the socket gets its own correlation id, prefixed with the connection's
+            turn_no += 1
+            request_id.set(f"{connection_id}.{turn_no}")
+            relay = TokenRelay(websocket)
+            try:
+                response = await _cancel_on_disconnect(
+                    _sequenced_turn(user_id, message, deadline=Deadline.for_request(frame.deadline_ms),
+                                    api_key=api_key, on_token=relay.push),
+                    gone
+                )
+                outcome = {"type": "done", "reply": response.reply, "metadata": response.metadata}
+                ws_stats["turns"] += 1
+            except HTTPException as e:
+                outcome = {"type": "error", "detail": e.detail}
+                if e.headers and "Retry-After" in e.headers:
+                    outcome["retry_after"] = int(e.headers["Retry-After"])
+            except StreamInterrupted as e:
+                # the token frames sent so far are all there is of this reply
+                outcome = {"type": "error", "detail": f"{e}, try again", "partial": True}
+            except ClientGone:
+                log.info(f"🔌 {user_id} closed the socket, turn cancelled")
+                return
+            except Exception as e:
+                # one bad turn shouldn't take the whole session down
+                log.exception(f"WebSocket turn for {user_id} failed: {e}")
+                outcome = {"type": "error", "detail": "Something went wrong with that message, try again"}
+            finally:
+                if gone.done():
+                    relay.task.cancel()
+                else:
+                    # everything streamed so far goes out before the final frame
+                    await relay.close()
+            await websocket.send_json(outcome)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: starlette refusing to send on a socket the client already closed
+        pass
+    finally:
+        reader.cancel()
+        ws_stats["open"] -= 1
+
 @router.post("/reset")
 async def reset_conversation(user_id: str):
     """Reset conversation memory for a user"""
     memory.clear_session(user_id)
-    return {"message": f"Conversation reset for {user_id}"}
\ No newline at end of file
+    return {"message": f"Conversation reset for {user_id}"}
+
+@router.delete("/memory/{user_id}")
+async def purge_user_memory(user_id: str):
+    """Permanently delete a user's short- and long-term memory"""
+    removed = await asyncio.to_thread(memory.forget_user, user_id)
+    turn_counter.pop(user_id, None)
+    return {"message": f"All memory deleted for {user_id}", "memories_removed": removed}
+
+@router.get("/usage")
+async def get_usage():
+    """Provider quota usage for the current minute/day (shared across workers)"""
+    return usage_tracker.snapshot()
+
+
+@router.get("/usage/clients")
+async def get_client_usage(top: int = 50):
+    """Per-user / per-API-key consumption and throttling in this worker, heaviest first"""
+    return fair_share.stats(top)
+
+
+@router.get("/memory/consolidation")
+async def get_consolidation_report():
+    """How much the last background consolidation pass shrank each user's memories"""
+    return last_report()
+
+
+@router.post("/profiling")
+async def start_profiling(fraction: float, duration_s: float = 300, x_profile: Optional[str] = Header(None)):
+    """Profile a random fraction of /message requests for the next duration_s seconds"""
+    if not PROFILE_TOKEN or x_profile != PROFILE_TOKEN:
+        raise HTTPException(status_code=403, detail="Profiling needs PROFILE_TOKEN in the X-Profile header")
+    profiler.sample_fraction(fraction, duration_s)
+    return profiler.stats()
+
+
+@router.get("/profiling")
+async def get_profiling():
+    return profiler.stats()
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """In-process performance counters for this worker"""
+    return {
+        "recall_cache": memory.recall_cache.stats() if memory.recall_cache else None,
+        "provider_latency": latency_tracker.stats(),
+        "hedging": hedge_budget.stats(),
+        "fair_share": fair_share.stats(top=5),
+        "websocket": ws_stats,
+        "cancellation": cancel_stats,
+        "idempotency": idempotency_store.stats(),
+        "recall_gate": recall_gate.stats(),
+        "turn_sequencer": turn_sequencer.stats(),
+        "embedding_cache": embedding_fn.cache.stats() if hasattr(embedding_fn, "cache") else None,
+        "output_tokens": output_token_stats.stats(),
+        "model_tiers": tier_stats.stats(),
+        "logging": log_stats(),
+    }
@@ -0,0 +1,118 @@
+"""
+Compare embedding backends for memory vectors (no server needed).
+Reports load time, RSS cost, batch throughput, single-text latency and how well
+each backend's retrieval agrees with the reference (PyTorch sentence-transformers).
+
+    python bench_embeddings.py
+    python bench_embeddings.py --backends onnx onnx-int8 --threads 2
+"""
+
+import os
+import time
+import random
+import argparse
+import numpy as np
+from app.db.embeddings import BACKENDS, make_embedding_function
+
+SUBJECTS = ["naruto", "real madrid", "valorant", "exams", "my dog", "python", "mumbai", "death note",
+            "the new iphone", "my sister", "arsenal", "cooking", "gym", "college", "taylor swift"]
+VERBS = ["i love", "i hate", "been thinking about", "tell me about", "my favorite is", "can't stop talking about",
+         "had a rough week with", "just started getting into", "what do you think of", "i'm so done with"]
+
+
+def corpus(n: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    return [f"{rng.choice(VERBS)} {rng.choice(SUBJECTS)} {rng.choice(['lol', 'fr', 'ngl', '', 'honestly'])}".strip()
+            for _ in range(n)]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return float("nan")
+
+
+def embed(fn, texts: list, batch: int) -> np.ndarray:
+    out = []
+    for i in range(0, len(texts), batch):
+        out.extend(fn(texts[i:i + batch]))
+    return np.asarray(out, dtype=np.float32)
+
+
+def top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    return np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+
+
+def bench(backend: str, threads: int, docs: list, queries: list, batch: int, latency_runs: int) -> dict:
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    fn = make_embedding_function(backend, threads)
+    fn(["warm up"])
+    load_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    doc_vecs = embed(fn, docs, batch)
+    throughput = len(docs) / (time.perf_counter() - start)
+
+    latencies = []
+    for text in queries[:latency_runs]:
+        start = time.perf_counter()
+        fn([text])
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+
+    return {
+        "backend": backend,
+        "load_s": load_s,
+        "rss_mb": rss_mb() - rss_before,
+        "throughput": throughput,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(len(latencies) * 0.95)],
+        "doc_vecs": doc_vecs,
+        "query_vecs": embed(fn, queries, batch),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--k", type=int, default=6)
+    args = parser.parse_args()
+
+    docs = corpus(args.docs)
+    queries = corpus(args.queries, seed=11)
+
+    results = []
+    for backend in args.backends:
+        try:
+            results.append(bench(backend, args.threads, docs, queries, args.batch, args.queries))
+        except Exception as e:
+            print(f"✗ {backend}: {e}")
+
+    if not results:
+        return
+
+    # first backend that ran is the reference for agreement
+    ref = results[0]
+    ref_top = top_k(ref["doc_vecs"], ref["query_vecs"], args.k)
+
+    print(f"\n{args.docs} docs, {args.queries} queries, batch {args.batch}, threads {args.threads or 'default'}")
+    print(f"{'backend':<22} {'load s':>7} {'+RSS MB':>8} {'texts/s':>9} {'p50 ms':>7} {'p95 ms':>7} "
+          f"{'cos vs ref':>10} {'top-' + str(args.k) + ' overlap':>14}")
+    for r in results:
+        cosine = float(np.mean(np.sum(r["doc_vecs"] * ref["doc_vecs"], axis=1)))
+        top = top_k(r["doc_vecs"], r["query_vecs"], args.k)
+        overlap = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(top, ref_top)])
+        print(f"{r['backend']:<22} {r['load_s']:>7.2f} {r['rss_mb']:>8.0f} {r['throughput']:>9.0f} "
+              f"{r['p50_ms']:>7.2f} {r['p95_ms']:>7.2f} {cosine:>10.4f} {overlap:>14.3f}")
+    print(f"(agreement measured against {ref['backend']}; RSS is the growth while loading/using that backend)")
+
+
+if __name__ == "__main__":
+    main()
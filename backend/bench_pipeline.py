@@ -0,0 +1,223 @@
+"""
+In-process benchmark of the server-side turn pipeline (no server, no real LLM).
+Drives MemoryManager + vector_store + build_prompt over a synthetic corpus and
+writes per-function timings, allocations and a memory-growth curve to JSON.
+
+    python bench_pipeline.py --users 2000 --turns 10
+    python bench_pipeline.py --compare bench_results/<older>.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import hashlib
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+# keep the benchmark away from the real memory store / quota ledger
+_SCRATCH = tempfile.mkdtemp(prefix="stan_bench_")
+os.environ.setdefault("CHROMA_PATH", os.path.join(_SCRATCH, "chroma"))
+os.environ.setdefault("QUOTA_DB_PATH", os.path.join(_SCRATCH, "quota.sqlite3"))
+os.environ.setdefault("CONSOLIDATION_ENABLED", "false")
+
+from app.core.memory_manager import MemoryManager  # noqa: E402
+from app.core.prompt_templates import build_prompt  # noqa: E402
+from app.core.message_analysis import analyze_message  # noqa: E402
+
+RESULTS_DIR = "bench_results"
+
+NAMES = ["raj", "ana", "kenji", "maria", "omar", "li", "sam", "priya", "jonas", "tara"]
+ANIME = ["naruto", "death note", "attack on titan", "one piece", "bleach", "jujutsu kaisen"]
+CLUBS = ["real madrid", "barcelona", "arsenal", "liverpool", "bayern munich", "psg"]
+CITIES = ["mumbai", "berlin", "tokyo", "lagos", "toronto", "lisbon"]
+
+TEMPLATES = [
+    "my name is {name}",
+    "i love {anime}",
+    "my favorite club is {club}",
+    "i live in {city}",
+    "hey",
+    "lol",
+    "what's my name?",
+    "what anime do i like?",
+    "tell me about {anime}",
+    "had a really rough day at college today, exams are killing me",
+    "been playing valorant all night with my friends from {city}",
+    "do you think {club} will win the league this year",
+]
+
+
+def make_message(rng: random.Random) -> str:
+    return rng.choice(TEMPLATES).format(
+        name=rng.choice(NAMES), anime=rng.choice(ANIME),
+        club=rng.choice(CLUBS), city=rng.choice(CITIES)
+    )
+
+
+def stub_generate(prompt: str, user_message: str) -> str:
+    """Deterministic stand-in for llm_client.generate"""
+    digest = hashlib.md5(f"{len(prompt)}:{user_message}".encode()).hexdigest()
+    return f"ngl that's cool, tell me more ({digest[:6]})"
+
+
+class Recorder:
+    """Per-function wall time, plus allocated bytes when tracemalloc is on"""
+    def __init__(self):
+        self.times = {}
+        self.allocs = {}
+
+    def call(self, name: str, fn, *args, **kwargs):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if tracing:
+            self.allocs.setdefault(name, []).append(tracemalloc.get_traced_memory()[1] - before)
+        else:
+            self.times.setdefault(name, []).append(elapsed)
+        return result
+
+    def summary(self) -> dict:
+        out = {}
+        for name, samples in self.times.items():
+            ordered = sorted(samples)
+            n = len(ordered)
+            allocs = self.allocs.get(name, [])
+            out[name] = {
+                "calls": n,
+                "total_s": round(sum(ordered), 4),
+                "mean_ms": round(1000 * sum(ordered) / n, 4),
+                "p50_ms": round(1000 * ordered[n // 2], 4),
+                "p95_ms": round(1000 * ordered[int(n * 0.95)], 4),
+                "p99_ms": round(1000 * ordered[min(n - 1, int(n * 0.99))], 4),
+                "alloc_peak_kb_mean": round(sum(allocs) / len(allocs) / 1024, 2) if allocs else None,
+            }
+        return out
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is a peak, but it's the best we have off linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_turn(memory: MemoryManager, rec: Recorder, user_id: str, turn_id: int, message: str):
+    analysis = rec.call("analyze_message", analyze_message, message)
+    rec.call("save_interaction[user]", memory.save_interaction,
+             user_id, message, turn_id, True, analysis)
+    retrieved = rec.call("recall_context", memory.recall_context, user_id, message, 6)
+    recent = rec.call("get_recent_context", memory.get_recent_context, user_id)
+    prompt = rec.call("build_prompt", build_prompt, user_id, recent, retrieved, message)
+    reply = stub_generate(prompt, message)
+    rec.call("save_interaction[assistant]", memory.save_interaction, user_id, reply, turn_id, False)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nvs {baseline_path} ({baseline['meta'].get('commit')}):")
+    for name, stats in current["functions"].items():
+        old = baseline["functions"].get(name)
+        if not old:
+            continue
+        delta = 100 * (stats["mean_ms"] - old["mean_ms"]) / max(old["mean_ms"], 1e-9)
+        flag = "⚠️ " if delta > 10 else "  "
+        print(f"{flag}{name:<28} {old['mean_ms']:>9.3f} → {stats['mean_ms']:>9.3f} ms  ({delta:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=8, help="turns per user")
+    parser.add_argument("--alloc-sample", type=int, default=200, help="turns re-run under tracemalloc")
+    parser.add_argument("--curve-points", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--compare", default=None, help="earlier result JSON to diff against")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    memory = MemoryManager()
+    rec = Recorder()
+    users = [f"bench_{i}" for i in range(args.users)]
+    curve = []
+    total = args.users * args.turns
+    every = max(1, total // args.curve_points)
+
+    print(f"Benchmarking {args.users} users x {args.turns} turns (scratch: {_SCRATCH})")
+    start = time.perf_counter()
+
+    # timing pass - turns interleaved across users like real traffic
+    done = 0
+    for turn_id in range(1, args.turns + 1):
+        for user_id in users:
+            run_turn(memory, rec, user_id, turn_id, make_message(rng))
+            done += 1
+            if done % every == 0:
+                curve.append({"turns": done, "elapsed_s": round(time.perf_counter() - start, 2),
+                              "rss_mb": round(rss_mb(), 1)})
+
+    wall = time.perf_counter() - start
+
+    # allocation pass on a sample, kept separate because tracemalloc skews timings
+    tracemalloc.start()
+    for i in range(args.alloc_sample):
+        run_turn(memory, rec, users[i % len(users)], args.turns + 1 + i // len(users), make_message(rng))
+    tracemalloc.stop()
+
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "users": args.users,
+            "turns_per_user": args.turns,
+            "seed": args.seed,
+            "wall_s": round(wall, 2),
+            "turns_per_s": round(args.users * args.turns / wall, 1),
+        },
+        "functions": rec.summary(),
+        "memory_curve": curve,
+    }
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = args.out or os.path.join(RESULTS_DIR, f"bench_pipeline_{result['meta']['commit']}_{int(time.time())}.json")
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"\n{'function':<28} {'calls':>7} {'mean ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'alloc KB':>9}")
+    for name, stats in result["functions"].items():
+        alloc = stats["alloc_peak_kb_mean"]
+        print(f"{name:<28} {stats['calls']:>7} {stats['mean_ms']:>9.3f} {stats['p95_ms']:>9.3f} "
+              f"{stats['p99_ms']:>9.3f} {alloc if alloc is not None else '-':>9}")
+    print(f"\n{result['meta']['turns_per_s']} turns/s, RSS {curve[-1]['rss_mb'] if curve else '?'} MB")
+    print(f"Saved to {out}")
+
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Micro-benchmark for the recall re-ranking stage (no server / chroma needed).
+Measures the extra per-turn work recall_context does on top of the chroma query.
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+from app.core.memory_manager import memory_importance
+from app.core.reranker import rerank, ages_in_seconds, RERANK_OVERFETCH
+
+TOP_K = 6
+TURNS = 20_000
+BUDGET_MS = 1.0
+
+SAMPLE_DOCS = [
+    "User's name: Raj",
+    "Favorite club: Real Madrid",
+    "Loves anime: Naruto",
+    "Lives in: Mumbai",
+    "i had a really long day at college and the exams are next week",
+    "been playing valorant with my friends every night lately",
+]
+
+
+def make_candidates(n: int):
+    now = datetime.now()
+    docs, metas, dists = [], [], []
+    for _ in range(n):
+        docs.append(random.choice(SAMPLE_DOCS))
+        metas.append({
+            "role": random.choice(["user", "user", "assistant"]),
+            "turn_id": random.randint(1, 500),
+            "timestamp": (now - timedelta(minutes=random.randint(0, 60 * 24 * 60))).isoformat(),
+        })
+        dists.append(random.uniform(0.3, 1.6))
+    return docs, metas, dists
+
+
+def main():
+    n = TOP_K * RERANK_OVERFETCH
+    batches = [make_candidates(n) for _ in range(200)]
+
+    timings = []
+    for turn in range(TURNS):
+        docs, metas, dists = batches[turn % len(batches)]
+        start = time.perf_counter()
+        importance = [memory_importance(d, m) for d, m in zip(docs, metas)]
+        rerank(dists, ages_in_seconds(metas), importance, len(docs))
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    p50 = timings[len(timings) // 2]
+    p99 = timings[int(len(timings) * 0.99)]
+
+    print(f"Re-ranking {n} candidates -> top {TOP_K}, {TURNS} turns")
+    print(f"  mean: {mean * 1000:.1f} µs   p50: {p50 * 1000:.1f} µs   p99: {p99 * 1000:.1f} µs")
+    print(f"  {'✓ under' if p99 < BUDGET_MS else '✗ over'} {BUDGET_MS} ms per-turn budget")
+
+
+if __name__ == "__main__":
+    main()